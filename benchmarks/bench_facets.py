@@ -0,0 +1,49 @@
+import os
+import sys
+import time
+import random
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from facets import FacetIndex
+from bench_ranking import GENRES
+
+
+def make_index(n: int) -> FacetIndex:
+    rng = random.Random(42)
+    ids = list(range(1, n + 1))
+    genre_lists = [rng.sample(GENRES, rng.randint(1, 4)) for _ in ids]
+    # Как в каталоге: строки упорядочены по рейтингу
+    ratings = sorted((round(rng.uniform(3, 9.5), 1) for _ in ids), reverse=True)
+    years = [rng.randint(1950, 2026) for _ in ids]
+    return FacetIndex(ids, genre_lists, ratings, years)
+
+
+def timed(fn, iterations: int) -> list:
+    for _ in range(20):
+        fn()
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1e6)
+    timings.sort()
+    return timings
+
+
+def bench(n: int, iterations: int):
+    index = make_index(n)
+    query = lambda: index.query(["драма", "комедия"], "all", 1990, 2010, 7.0)
+    positions = query()
+    for name, fn in (("query", query), ("facets", lambda: index.facet_counts(positions))):
+        timings = timed(fn, iterations)
+        print(f"n={n:>6} {name:<7} hits={len(positions):>5}  "
+              f"p50={statistics.median(timings):8.1f} мкс  "
+              f"p99={timings[int(len(timings) * 0.99) - 1]:8.1f} мкс")
+
+
+if __name__ == "__main__":
+    iterations = int(os.getenv("BENCH_ITERATIONS", "500"))
+    for n in (5000, 20000, 200000):
+        bench(n, iterations)
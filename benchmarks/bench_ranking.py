@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import random
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ranking import CandidateSet
+from database import pack_film_ids, unpack_film_ids
+
+GENRES = ["драма", "комедия", "боевик", "триллер", "ужасы", "фантастика", "мелодрама", "детектив",
+          "приключения", "мультфильм", "криминал", "фэнтези", "семейный", "военный", "история",
+          "биография", "документальный", "вестерн", "мюзикл", "спорт"]
+
+
+def make_candidates(n: int) -> CandidateSet:
+    rng = random.Random(42)
+    ids = list(range(1, n + 1))
+    genre_lists = [rng.sample(GENRES, rng.randint(1, 4)) for _ in ids]
+    ratings = [round(rng.uniform(3, 9.5), 1) if rng.random() > 0.05 else None for _ in ids]
+    years = [rng.randint(1950, 2026) for _ in ids]
+    return CandidateSet(ids, genre_lists, ratings, years)
+
+
+def bench(n: int, shown: int, iterations: int):
+    candidates = make_candidates(n)
+    rng = random.Random(7)
+    # В том же виде, в каком показанные фильмы хранит сессия
+    shown_ids = unpack_film_ids(pack_film_ids(rng.sample(range(1, n + 1), min(shown, n))))
+    genres_a, genres_b = rng.sample(GENRES, 3), rng.sample(GENRES, 3)
+    for _ in range(50):
+        candidates.rank(genres_a, genres_b, shown_ids, k=10)
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        candidates.rank(genres_a, genres_b, shown_ids, k=10)
+        timings.append((time.perf_counter() - start) * 1e6)
+    timings.sort()
+    print(f"n={n:>6} shown={len(shown_ids):>4}  "
+          f"p50={statistics.median(timings):8.1f} мкс  "
+          f"p99={timings[int(len(timings) * 0.99) - 1]:8.1f} мкс")
+
+
+if __name__ == "__main__":
+    iterations = int(os.getenv("BENCH_ITERATIONS", "2000"))
+    for n in (1000, 5000, 20000):
+        bench(n, shown=200, iterations=iterations)
@@ -0,0 +1,194 @@
+# Нагрузочный прогон всех эндпоинтов main.py с фиксированным параллелизмом.
+#
+#   python benchmarks/stub_kinopoisk.py --port 9000 &
+#   KINOPOISK_BASE_URL=http://127.0.0.1:9000/api DB_PATH=/tmp/bench.db python main.py &
+#   python benchmarks/load_test.py --url http://127.0.0.1:8000 --concurrency 32 --requests 300 \
+#       --save benchmarks/baselines/local.json
+#   python benchmarks/load_test.py --compare benchmarks/baselines/local.json
+#
+# Масштабирование по воркерам — тот же прогон при WORKERS=1 и WORKERS=N (на N свободных ядрах).
+# genre_year упирается в общую квоту апстрима и с числом воркеров не растёт.
+#
+# Для каждого сценария считаются пропускная способность, p50/p95/p99 и число ошибок.
+# --compare печатает разницу с сохранённым прогоном и завершается с кодом 1,
+# если p95 какого-либо сценария вырос больше чем на --max-regression.
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import platform
+import httpx
+
+TITLES = ["матрица", "Зелёная", "елки", "интерстелар", "брат", "крестный", "Форрест", "побег"]
+ACTORS = ["Том Хэнкс", "Леонардо ДиКаприо", "Юрий Никулин"]
+GENRES = ["драма", "комедия", "боевик", "триллер", "фантастика", "криминал"]
+POSTER_SIZES = ["small", "medium", "original"]
+
+
+def _filter_query():
+    genres = "&".join(f"genre={g}" for g in random.sample(GENRES, random.randint(1, 2)))
+    year_from = random.randint(1970, 2010)
+    return f"{genres}&genre_mode={random.choice(['all', 'any'])}&year_from={year_from}&year_to={year_from + random.randint(0, 15)}"
+
+
+def build_scenarios(session_id: str, catalog_ids: list):
+    user = f"bench-{uuid.uuid4().hex[:8]}"
+    film_ids = list(range(300, 5000, 37))
+    return {
+        "root": lambda: ("GET", "/", None),
+        "random_movie": lambda: ("GET", "/api/random-movie?count=5", None),
+        "random_series": lambda: ("GET", "/api/random-series?count=5", None),
+        "genre_year": lambda: ("GET", f"/api/search-by-genre-year?genre={random.choice(GENRES)}&year={random.randint(1990, 2015)}", None),
+        "genre_year_stream": lambda: ("GET", f"/api/search-by-genre-year?genre={random.choice(GENRES)}&year={random.randint(1990, 2015)}&pages=5", None),
+        "title": lambda: ("GET", f"/api/search-by-title?title={random.choice(TITLES)}", None),
+        "actor": lambda: ("GET", f"/api/search-by-actor?actor={random.choice(ACTORS)}", None),
+        "add_to_collection": lambda: ("POST", f"/api/add-to-collection?user_id={user}&film_id={random.choice(film_ids)}", None),
+        "films_filter": lambda: ("GET", f"/api/films/filter?{_filter_query()}", None),
+        "films_facets": lambda: ("GET", f"/api/films/facets?{_filter_query()}&min_rating={random.choice([0, 5, 7])}", None),
+        # Постеры фильмов, уже лежащих в каталоге: первый запрос — загрузка и миниатюра, дальше — диск
+        "poster": lambda: ("GET", f"/posters/{random.choice(catalog_ids)}?size={random.choice(POSTER_SIZES)}", None),
+        "collection": lambda: ("GET", f"/api/user-collections/{user}", None),
+        "collection_films": lambda: ("GET", f"/api/user-collections/{user}/films", None),
+        "collection_batch": lambda: ("POST", f"/api/user-collections/{user}/batch", {"film_ids": random.sample(film_ids, 20)}),
+        "collection_contains": lambda: ("POST", f"/api/user-collections/{user}/contains", {"film_ids": random.sample(film_ids, 50)}),
+        "session_create": lambda: ("POST", "/api/sessions", {"user_a": f"{user}-a", "user_b": f"{user}-b"}),
+        "session_genres": lambda: ("POST", f"/api/sessions/{session_id}/genres",
+                                   {"user_id": random.choice(["a", "b"]), "genres": random.sample(GENRES, 3)}),
+        "session_vote": lambda: ("POST", f"/api/sessions/{session_id}/votes",
+                                 {"user_id": random.choice(["a", "b"]), "film_id": random.choice(film_ids), "vote": random.random() < 0.5}),
+        "session_vote_batch": lambda: ("POST", f"/api/sessions/{session_id}/votes/batch",
+                                       {"votes": [{"user_id": "a", "film_id": i, "vote": True} for i in random.sample(film_ids, 20)]}),
+        "session_next_film": lambda: ("POST", f"/api/sessions/{session_id}/next-film", None),
+        "session_matches": lambda: ("GET", f"/api/sessions/{session_id}/matches", None),
+        "cache_stats": lambda: ("GET", "/api/cache/stats", None),
+    }
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+async def run_scenario(client, name, make_request, concurrency, total):
+    latencies, errors, statuses = [], 0, {}
+    remaining = total
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            method, path, body = make_request()
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, json=body)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+                statuses["exception"] = statuses.get("exception", 0) + 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": total,
+        "errors": errors,
+        "statuses": {str(k): v for k, v in statuses.items()},
+        "throughput_rps": round(total / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+    }
+
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        response = await client.post("/api/sessions", json={"user_a": "a", "user_b": "b"})
+        response.raise_for_status()
+        session_id = response.json()["session_id"]
+        await client.post(f"/api/sessions/{session_id}/genres", json={"user_id": "a", "genres": GENRES[:3]})
+        await client.post(f"/api/sessions/{session_id}/genres", json={"user_id": "b", "genres": GENRES[2:5]})
+
+        # Фильмы из пула случайных уже записаны в каталог — у них есть источник постера
+        response = await client.get("/api/random-movie?count=50")
+        response.raise_for_status()
+        catalog_ids = [film["id"] for film in response.json()] or [1]
+
+        scenarios = build_scenarios(session_id, catalog_ids)
+        selected = args.only or list(scenarios)
+        results = {}
+        for name in selected:
+            # Прогрев: кэши и пулы заполняются до замера
+            await run_scenario(client, name, scenarios[name], min(args.concurrency, 4), args.warmup)
+            results[name] = await run_scenario(client, name, scenarios[name], args.concurrency, args.requests)
+            r = results[name]
+            print(f"{name:<22} {r['throughput_rps']:>9.1f} rps  p50 {r['p50_ms']:>8.2f}  "
+                  f"p95 {r['p95_ms']:>8.2f}  p99 {r['p99_ms']:>8.2f} мс  ошибок {r['errors']}")
+    return {
+        "meta": {
+            "url": args.url,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def compare(current, baseline, max_regression):
+    regressed = []
+    print(f"\n{'сценарий':<22} {'rps':>16} {'p95, мс':>22}")
+    for name, r in current["results"].items():
+        base = baseline["results"].get(name)
+        if not base:
+            continue
+        rps_delta = (r["throughput_rps"] - base["throughput_rps"]) / base["throughput_rps"] * 100
+        p95_delta = (r["p95_ms"] - base["p95_ms"]) / base["p95_ms"] * 100 if base["p95_ms"] else 0.0
+        mark = ""
+        if p95_delta > max_regression * 100:
+            regressed.append(name)
+            mark = "  <-- регрессия"
+        print(f"{name:<22} {r['throughput_rps']:>8.1f} ({rps_delta:+6.1f}%) {r['p95_ms']:>10.2f} ({p95_delta:+6.1f}%){mark}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон Film API")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=300, help="запросов на сценарий")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--only", nargs="*", help="прогнать только указанные сценарии")
+    parser.add_argument("--save", help="сохранить результат как JSON-базу")
+    parser.add_argument("--compare", help="сравнить с сохранённой базой")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="допустимый рост p95 (доля)")
+    args = parser.parse_args()
+
+    current = asyncio.run(run(args))
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+        print(f"Результат сохранён в {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(current, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
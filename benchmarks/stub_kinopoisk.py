@@ -0,0 +1,158 @@
+# Локальная заглушка API Кинопоиска для нагрузочного тестирования.
+#
+#   python benchmarks/stub_kinopoisk.py --port 9000 --latency-ms 80 --jitter-ms 40 --error-rate 0.01
+#   KINOPOISK_BASE_URL=http://127.0.0.1:9000/api python main.py
+#
+# Отдаёт записанные ответы из benchmarks/fixtures. Страницы выдачи размножаются
+# сдвигом filmId, чтобы пулы случайных фильмов видели разные фильмы на разных страницах.
+# Ссылки на постеры ведут на саму заглушку (/images/...): прокси постеров нагружается без выхода в сеть.
+import io
+import os
+import json
+import random
+import asyncio
+import argparse
+from functools import lru_cache
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "50"))
+STUB_JITTER_MS = float(os.getenv("STUB_JITTER_MS", "20"))
+STUB_ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", "0"))
+STUB_RATE_LIMIT_RATE = float(os.getenv("STUB_RATE_LIMIT_RATE", "0"))
+STUB_PAGES = int(os.getenv("STUB_PAGES", "20"))
+PAGE_SIZE = 20
+PAGE_ID_STEP = 100000
+POSTER_WIDTH, POSTER_HEIGHT = 360, 540
+# PNG 1x1 — если Pillow не установлен
+FALLBACK_POSTER = bytes.fromhex(
+    "89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489"
+    "0000000d49444154789c6360000002000100e221bc330000000049454e44ae426082"
+)
+
+
+def _load(name):
+    with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as f:
+        return json.load(f)
+
+
+FILMS = _load("films.json")["films"]
+STAFF = _load("staff.json")
+STAFF_FILMS = _load("staff_films.json")
+
+app = FastAPI(title="Kinopoisk stub")
+stats = {"requests": 0, "errors": 0, "rate_limited": 0}
+
+
+@app.middleware("http")
+async def inject_latency_and_errors(request: Request, call_next):
+    stats["requests"] += 1
+    delay = max(0.0, STUB_LATENCY_MS + random.uniform(-STUB_JITTER_MS, STUB_JITTER_MS)) / 1000
+    await asyncio.sleep(delay)
+    roll = random.random()
+    if roll < STUB_RATE_LIMIT_RATE:
+        stats["rate_limited"] += 1
+        return JSONResponse({"message": "Too many requests"}, status_code=429, headers={"Retry-After": "1"})
+    if roll < STUB_RATE_LIMIT_RATE + STUB_ERROR_RATE:
+        stats["errors"] += 1
+        return JSONResponse({"message": "Internal error"}, status_code=503)
+    return await call_next(request)
+
+
+def _with_stub_poster(film, base_url):
+    url = f"{base_url}images/posters/kp_small/{film['filmId']}.jpg"
+    return {**film, "posterUrl": url, "posterUrlPreview": url}
+
+
+@lru_cache(maxsize=4096)
+def _poster(film_id: int) -> bytes:
+    # У каждого фильма своя картинка, иначе кэш постеров (по хешу содержимого) хранил бы один файл
+    if Image is None:
+        return FALLBACK_POSTER
+    color = ((film_id * 37) % 256, (film_id * 91) % 256, (film_id * 53) % 256)
+    output = io.BytesIO()
+    Image.new("RGB", (POSTER_WIDTH, POSTER_HEIGHT), color).save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+
+def _matches(film, filters):
+    for field, value in filters:
+        if field == "type" and film["type"] != value:
+            return False
+        if field == "name.ru" and value.casefold() not in (film["nameRu"] or "").casefold():
+            return False
+        if field == "genres.name" and value not in [g["genre"] for g in film["genres"]]:
+            return False
+        if field == "year" and film["year"] != value:
+            return False
+    return True
+
+
+@app.get("/api/v2.2/films")
+async def films(request: Request):
+    params = request.query_params
+    filters = list(zip(params.getlist("field"), params.getlist("value")))
+    page = int(params.get("page", 1))
+    if page > STUB_PAGES:
+        return {"pagesCount": STUB_PAGES, "films": []}
+    found = [f for f in FILMS if _matches(f, filters)]
+    shift = (page - 1) * PAGE_ID_STEP
+    items = [_with_stub_poster({**f, "filmId": f["filmId"] + shift}, request.base_url) for f in found[:PAGE_SIZE]]
+    return {"pagesCount": STUB_PAGES, "films": items}
+
+
+@app.get("/api/v1/staff")
+async def staff(name: str = "", filmId: int = 0):
+    key = name.casefold()
+    return [p for p in STAFF if key and (key in p["nameRu"].casefold() or key in (p["nameEn"] or "").casefold())]
+
+
+@app.get("/api/v2.2/films/{film_id}")
+async def film(request: Request, film_id: int):
+    # Карточка фильма: записанный фильм с тем же id на любой странице выдачи
+    base = next((f for f in FILMS if f["filmId"] == film_id % PAGE_ID_STEP), None)
+    if base is None:
+        return JSONResponse({"message": "Film not found"}, status_code=404)
+    card = {k: v for k, v in _with_stub_poster({**base, "filmId": film_id}, request.base_url).items() if k not in ("filmId", "rating")}
+    return {**card, "kinopoiskId": film_id, "ratingKinopoisk": base.get("rating")}
+
+
+@app.get("/api/v1/staff/{staff_id}/films")
+async def staff_films(staff_id: int):
+    return STAFF_FILMS.get(str(staff_id), [])
+
+
+@app.get("/images/posters/{kind}/{name}")
+async def poster(name: str):
+    film_id = int(name.split(".")[0]) if name.split(".")[0].isdigit() else 0
+    data = _poster(film_id)
+    return Response(data, media_type="image/jpeg" if Image is not None else "image/png")
+
+
+@app.get("/stub/stats")
+async def stub_stats():
+    return stats
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Заглушка API Кинопоиска")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=STUB_LATENCY_MS)
+    parser.add_argument("--jitter-ms", type=float, default=STUB_JITTER_MS)
+    parser.add_argument("--error-rate", type=float, default=STUB_ERROR_RATE)
+    parser.add_argument("--rate-limit-rate", type=float, default=STUB_RATE_LIMIT_RATE)
+    parser.add_argument("--pages", type=int, default=STUB_PAGES)
+    args = parser.parse_args()
+    STUB_LATENCY_MS, STUB_JITTER_MS = args.latency_ms, args.jitter_ms
+    STUB_ERROR_RATE, STUB_RATE_LIMIT_RATE, STUB_PAGES = args.error_rate, args.rate_limit_rate, args.pages
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
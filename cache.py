@@ -0,0 +1,333 @@
+import os
+import time
+import pickle
+import sqlite3
+import asyncio
+import logging
+import functools
+import threading
+from collections import OrderedDict
+from workers import SHARED_STATE
+
+logger = logging.getLogger(__name__)
+
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "2048"))
+# Сколько секунд после истечения TTL ещё можно отдавать устаревшее значение, обновляя его в фоне
+CACHE_STALE_TTL = float(os.getenv("CACHE_STALE_TTL", "300"))
+# Второй уровень кэша, общий для воркеров (только при SHARED_STATE)
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "/app/data/cache.db")
+CACHE_SHARED_PURGE_EVERY = 1000
+# Пока один воркер загружает ключ, остальные ждут его результат в общем кэше не дольше этого
+CACHE_SHARED_LEASE_SECONDS = float(os.getenv("CACHE_SHARED_LEASE_SECONDS", "15"))
+CACHE_SHARED_POLL_SECONDS = 0.05
+
+
+class _Entry:
+    # body/etag — сериализованный ответ, вычисляется при первой отдаче клиенту и живёт вместе со значением
+    __slots__ = ("value", "fresh_until", "stale_until", "body", "etag")
+
+    def __init__(self, value, ttl: float, stale_ttl: float):
+        now = time.monotonic()
+        self.value = value
+        self.body = None
+        self.etag = None
+        self.fresh_until = now + ttl
+        self.stale_until = self.fresh_until + stale_ttl
+
+
+class SharedStore:
+    # Отдельный файл SQLite, чтобы запись кэша не спорила за блокировку с основной БД.
+    # Значения — pickle, сроки — по time.time(): monotonic-часы у процессов разные.
+    # Потеря кэша при сбое не страшна, поэтому synchronous=OFF.
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    fresh_until REAL NOT NULL,
+                    stale_until REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_leases (
+                    key TEXT PRIMARY KEY,
+                    owner INTEGER NOT NULL,
+                    expires_at REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        # -> (значение, сколько секунд оно ещё свежее) или None; устаревшие записи не берём —
+        # их всё равно нужно обновлять у апстрима
+        now = time.time()
+        row = self._connection().execute(
+            "SELECT value, fresh_until FROM cache_entries WHERE key = ? AND fresh_until > ?",
+            (repr(key), now),
+        ).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0]), row[1] - now
+
+    def put(self, key, value, ttl: float, stale_ttl: float):
+        now = time.time()
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache_entries (key, value, fresh_until, stale_until) VALUES (?, ?, ?, ?)",
+            (repr(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL), now + ttl, now + ttl + stale_ttl),
+        )
+        conn.execute("DELETE FROM cache_leases WHERE key = ? AND owner = ?", (repr(key), os.getpid()))
+        self._writes += 1
+        if self._writes % CACHE_SHARED_PURGE_EVERY == 0:
+            conn.execute("DELETE FROM cache_entries WHERE stale_until < ?", (now,))
+            conn.execute("DELETE FROM cache_leases WHERE expires_at < ?", (now,))
+
+    def acquire(self, key, seconds: float) -> bool:
+        # Межпроцессное слияние запросов: к апстриму за ключом идёт только владелец аренды.
+        # Аренда упавшего воркера истекает сама
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM cache_leases WHERE key = ? AND expires_at < ?", (repr(key), now))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO cache_leases (key, owner, expires_at) VALUES (?, ?, ?)",
+                (repr(key), os.getpid(), now + seconds),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.rowcount == 1
+
+    def release(self, key):
+        self._connection().execute("DELETE FROM cache_leases WHERE key = ? AND owner = ?", (repr(key), os.getpid()))
+
+    def is_leased(self, key) -> bool:
+        row = self._connection().execute(
+            "SELECT 1 FROM cache_leases WHERE key = ? AND expires_at > ?", (repr(key), time.time())
+        ).fetchone()
+        return row is not None
+
+
+class TTLCache:
+    def __init__(self, max_size: int = CACHE_MAX_SIZE, shared: SharedStore = None):
+        self.max_size = max_size
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.stats = {
+            "hits": 0,
+            "stale_hits": 0,
+            "shared_hits": 0,
+            "shared_waits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "refreshes": 0,
+            "evictions": 0,
+            "errors": 0,
+            "stale_if_error": 0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get_or_load(self, key, loader, ttl: float, stale_ttl: float = CACHE_STALE_TTL):
+        entry = await self.get_or_load_entry(key, loader, ttl, stale_ttl)
+        return entry.value
+
+    async def get_or_load_entry(self, key, loader, ttl: float, stale_ttl: float = CACHE_STALE_TTL):
+        entry = self._entries.get(key)
+        if entry is not None:
+            now = time.monotonic()
+            if now < entry.fresh_until:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry
+            if now < entry.stale_until:
+                # stale-while-revalidate: отдаём старое значение, обновление идёт в фоне
+                self._entries.move_to_end(key)
+                self.stats["stale_hits"] += 1
+                if key not in self._inflight:
+                    self.stats["refreshes"] += 1
+                    self._start_load(key, loader, ttl, stale_ttl)
+                return entry
+
+        task = self._inflight.get(key)
+        if task is not None:
+            # Такой же запрос уже идёт к апстриму — ждём его результат
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = self._start_load(key, loader, ttl, stale_ttl)
+        try:
+            # shield: отмена одного из ожидающих клиентов не должна отменять общий запрос
+            return await asyncio.shield(task)
+        except Exception:
+            if entry is None:
+                raise
+            # stale-if-error: апстрим недоступен, но старый ответ лучше, чем ошибка
+            self.stats["stale_if_error"] += 1
+            logger.warning("Апстрим недоступен, отдаём устаревшее значение для %s", key)
+            return entry
+
+    def _start_load(self, key, loader, ttl, stale_ttl):
+        task = asyncio.ensure_future(self._load(key, loader, ttl, stale_ttl))
+        self._inflight[key] = task
+        task.add_done_callback(self._log_background_error)
+        return task
+
+    async def _load(self, key, loader, ttl, stale_ttl):
+        leased = None
+        try:
+            entry = await self._load_shared(key, stale_ttl)
+            if entry is None:
+                leased = await self._lease_shared(key)
+                if leased is False:
+                    entry = await self._wait_shared(key, stale_ttl)
+            if entry is None:
+                try:
+                    value = await loader()
+                except Exception:
+                    if leased:
+                        await self._release_shared(key)
+                    raise
+                entry = _Entry(value, ttl, stale_ttl)
+                await self._store_shared(key, value, ttl, stale_ttl)
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        self._set(key, entry)
+        return entry
+
+    async def _load_shared(self, key, stale_ttl):
+        # Другой воркер мог уже сходить к апстриму за этим ключом
+        if self.shared is None:
+            return None
+        try:
+            found = await asyncio.to_thread(self.shared.get, key)
+        except Exception as e:
+            logger.warning("Общий кэш недоступен: %s", e)
+            return None
+        if found is None:
+            return None
+        self.stats["shared_hits"] += 1
+        value, remaining = found
+        return _Entry(value, remaining, stale_ttl)
+
+    async def _lease_shared(self, key):
+        # -> True: грузим мы; False: грузит другой воркер; None: общего кэша нет или он недоступен
+        if self.shared is None:
+            return None
+        try:
+            return await asyncio.to_thread(self.shared.acquire, key, CACHE_SHARED_LEASE_SECONDS)
+        except Exception as e:
+            logger.warning("Общий кэш недоступен: %s", e)
+            return None
+
+    async def _release_shared(self, key):
+        try:
+            await asyncio.to_thread(self.shared.release, key)
+        except Exception as e:
+            logger.warning("Не удалось снять аренду ключа в общем кэше: %s", e)
+
+    async def _wait_shared(self, key, stale_ttl):
+        # Ждём, пока владелец аренды положит значение; если он упал или получил ошибку — грузим сами
+        self.stats["shared_waits"] += 1
+        deadline = time.monotonic() + CACHE_SHARED_LEASE_SECONDS
+        while time.monotonic() < deadline:
+            await asyncio.sleep(CACHE_SHARED_POLL_SECONDS)
+            entry = await self._load_shared(key, stale_ttl)
+            if entry is not None:
+                return entry
+            try:
+                if not await asyncio.to_thread(self.shared.is_leased, key):
+                    return await self._load_shared(key, stale_ttl)
+            except Exception as e:
+                logger.warning("Общий кэш недоступен: %s", e)
+                return None
+        return None
+
+    async def _store_shared(self, key, value, ttl, stale_ttl):
+        if self.shared is None:
+            return
+        try:
+            await asyncio.to_thread(self.shared.put, key, value, ttl, stale_ttl)
+        except Exception as e:
+            # Ответ уже получен — ошибка общего кэша не должна его терять
+            logger.warning("Не удалось записать в общий кэш: %s", e)
+
+    def _set(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    @staticmethod
+    def _log_background_error(task):
+        # Ошибку фонового обновления никто не ждёт — забираем её, чтобы не было "exception never retrieved"
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Ошибка загрузки в кэш: %s", task.exception())
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def snapshot(self):
+        lookups = self.stats["hits"] + self.stats["stale_hits"] + self.stats["misses"] + self.stats["coalesced"]
+        served = self.stats["hits"] + self.stats["stale_hits"] + self.stats["coalesced"]
+        return {
+            **self.stats,
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "inflight": len(self._inflight),
+            "hit_ratio": round(served / lookups, 4) if lookups else 0.0,
+        }
+
+
+def _normalize(value):
+    if isinstance(value, str):
+        return " ".join(value.split()).casefold()
+    return value
+
+
+def make_key(endpoint: str, *args, **kwargs):
+    return (endpoint,) + tuple(_normalize(a) for a in args) + tuple(sorted((k, _normalize(v)) for k, v in kwargs.items()))
+
+
+# Кэш ответов апстрима: первый уровень в памяти процесса, второй (при нескольких воркерах) — общий файл
+film_cache = TTLCache(shared=SharedStore(CACHE_DB_PATH) if SHARED_STATE else None)
+
+
+def cached(endpoint: str, ttl: float, stale_ttl: float = CACHE_STALE_TTL):
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            key = make_key(endpoint, *args, **kwargs)
+            return await film_cache.get_or_load(key, lambda: fn(*args, **kwargs), ttl, stale_ttl)
+
+        async def entry(*args, **kwargs):
+            # Запись кэша целиком — чтобы отдать клиенту уже сериализованное тело и ETag
+            key = make_key(endpoint, *args, **kwargs)
+            return await film_cache.get_or_load_entry(key, lambda: fn(*args, **kwargs), ttl, stale_ttl)
+        wrapper.uncached = fn
+        wrapper.entry = entry
+        return wrapper
+    return decorator
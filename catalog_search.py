@@ -0,0 +1,200 @@
+import os
+import time
+import asyncio
+import logging
+from cache import cached
+from database import (
+    run_db,
+    fold_text,
+    search_titles_local,
+    get_staff_resolution,
+    save_staff_resolution,
+    get_staff_refreshed_at,
+    save_staff_films,
+    get_films_for_staff,
+    get_films_by_ids,
+    get_user_collection_films,
+)
+from kinopoisk_api import FilmPage, search_by_title, search_by_genre_and_year, search_staff, get_staff_films, get_film
+from facets import get_index
+from catalog_snapshot import mark_stale
+
+logger = logging.getLogger(__name__)
+
+TITLE_SEARCH_LIMIT = int(os.getenv("TITLE_SEARCH_LIMIT", "20"))
+# Если локально нашлось меньше — идём к апстриму и дополняем выдачу
+TITLE_LOCAL_MIN_RESULTS = int(os.getenv("TITLE_LOCAL_MIN_RESULTS", "5"))
+
+# Сроки жизни (секунды): имя -> staffId и список фильмов персоны
+STAFF_RESOLVE_TTL = int(os.getenv("STAFF_RESOLVE_TTL", str(30 * 24 * 3600)))
+STAFF_FILMS_TTL = int(os.getenv("STAFF_FILMS_TTL", str(7 * 24 * 3600)))
+CACHE_TTL_STAFF = float(os.getenv("CACHE_TTL_STAFF", "3600"))
+# Сколько персон с точно совпавшим именем учитываем (тёзки)
+ACTOR_MAX_CANDIDATES = int(os.getenv("ACTOR_MAX_CANDIDATES", "3"))
+
+FACET_PAGE_SIZE = int(os.getenv("FACET_PAGE_SIZE", "20"))
+# Если локально нашлось меньше — добираем из апстрима. Апстрим умеет только один жанр и один год,
+# поэтому догрузка идёт лишь для одного жанра и узкого диапазона лет (запрос на каждый год)
+FACET_FILL_MIN_RESULTS = int(os.getenv("FACET_FILL_MIN_RESULTS", "20"))
+FACET_FILL_MAX_YEARS = int(os.getenv("FACET_FILL_MAX_YEARS", "3"))
+# Сколько фильмов подборки, которых нет в каталоге, догружаем из апстрима за один запрос
+COLLECTION_HYDRATE_MAX = int(os.getenv("COLLECTION_HYDRATE_MAX", "20"))
+
+
+async def find_by_title(title: str, page: int = 1, skip=(), local_first: bool = True) -> FilmPage:
+    # Первая страница — локальный индекс; если его мало (или local_first=False) — вместе со страницей 1
+    # апстрима. Дальше — страницы апстрима. Показанные из локального индекса id уходят в курсор (skip),
+    # и следующие страницы их не повторяют; после чисто локальной страницы курсор ведёт на страницу 1 апстрима
+    if page > 1 or skip:
+        upstream = await search_by_title(title, page)
+        skipped = set(skip)
+        films = [film for film in upstream if film["id"] not in skipped]
+        return FilmPage(films, upstream.pages, cursor_state={"skip": list(skip)})
+    local = await run_db(search_titles_local, title, TITLE_SEARCH_LIMIT)
+    shown = {"skip": [film["id"] for film in local]}
+    if local_first and len(local) >= TITLE_LOCAL_MIN_RESULTS:
+        logger.info("Поиск по названию '%s' обслужен локально: %s фильмов", title, len(local))
+        return FilmPage(local, last_page=0, cursor_state=shown)
+    try:
+        upstream = await search_by_title(title, 1)
+    except Exception as e:
+        if not local:
+            raise
+        # Апстрим недоступен (ошибка, квота, открыт предохранитель) — отдаём то, что нашлось локально
+        logger.warning("Поиск по названию '%s': апстрим недоступен, только локальные результаты: %s", title, e)
+        return FilmPage(local, last_page=0, cursor_state=shown)
+    seen = set(shown["skip"])
+    return FilmPage(local + [film for film in upstream if film["id"] not in seen], upstream.pages, cursor_state=shown)
+
+
+def _name_key(name: str) -> str:
+    return " ".join(fold_text(name).split())
+
+
+def _pick_staff(staff_data: list, name_key: str) -> list:
+    exact = [
+        p["staffId"] for p in staff_data
+        if p.get("staffId") and name_key in (_name_key(p.get("nameRu") or ""), _name_key(p.get("nameEn") or ""))
+    ]
+    if exact:
+        return exact[:ACTOR_MAX_CANDIDATES]
+    # Точного совпадения нет — как и раньше, берём первого из выдачи
+    return [p["staffId"] for p in staff_data[:1] if p.get("staffId")]
+
+
+@cached("resolve_staff", ttl=CACHE_TTL_STAFF)
+async def resolve_staff(name: str) -> list:
+    name_key = _name_key(name)
+    staff_ids, resolved_at = await run_db(get_staff_resolution, name_key)
+    if staff_ids is not None and time.time() - resolved_at < STAFF_RESOLVE_TTL:
+        return staff_ids
+    try:
+        found = await search_staff(name)
+    except Exception as e:
+        if staff_ids is None:
+            raise
+        # Апстрим недоступен — устаревшее сопоставление лучше, чем ошибка
+        logger.warning("Персона '%s': апстрим недоступен, используем прежнее сопоставление: %s", name, e)
+        return staff_ids
+    staff_ids = _pick_staff(found, name_key)
+    await run_db(save_staff_resolution, name_key, staff_ids)
+    return staff_ids
+
+
+async def _refresh_staff_films(staff_id: int):
+    films = await get_staff_films(staff_id)
+    await run_db(save_staff_films, staff_id, [f["filmId"] for f in films if f.get("filmId")])
+
+
+async def find_by_actor(actor_name: str) -> list:
+    staff_ids = await resolve_staff(actor_name)
+    if not staff_ids:
+        logger.warning("Персона '%s' не найдена", actor_name)
+        return []
+    refreshed_at = await run_db(get_staff_refreshed_at, staff_ids)
+    now = time.time()
+    stale = [i for i in staff_ids if now - refreshed_at.get(i, 0) >= STAFF_FILMS_TTL]
+    if stale:
+        # Фильмы нескольких тёзок загружаем параллельно
+        logger.info("Обновление фильмов персон %s", stale)
+        results = await asyncio.gather(*(_refresh_staff_films(i) for i in stale), return_exceptions=True)
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            # Отдаём сохранённые ранее фильмы; ошибка — только если показать совсем нечего
+            if not any(i in refreshed_at for i in staff_ids):
+                raise errors[0]
+            logger.warning("Фильмы персон %s не обновлены, отдаём сохранённые: %s", stale, errors[0])
+    return await run_db(get_films_for_staff, staff_ids)
+
+
+def _fillable(genres, year_from, year_to) -> bool:
+    return (
+        len(genres) == 1
+        and year_from is not None
+        and year_to is not None
+        and 0 <= year_to - year_from < FACET_FILL_MAX_YEARS
+    )
+
+
+async def _fill_from_upstream(genre: str, year_from: int, year_to: int, min_rating) -> list:
+    results = await asyncio.gather(
+        *(search_by_genre_and_year(genre, year, 1) for year in range(year_from, year_to + 1)),
+        return_exceptions=True,
+    )
+    films = []
+    for page in results:
+        if isinstance(page, Exception):
+            logger.warning("Не удалось дополнить выборку из апстрима: %s", page)
+            continue
+        films.extend(f for f in page if min_rating is None or (f["rating"] is not None and f["rating"] >= min_rating))
+    return films
+
+
+async def filter_films(genres=(), genre_mode: str = "all", year_from=None, year_to=None,
+                       min_rating=None, page: int = 1, with_facets: bool = True) -> dict:
+    index = await get_index()
+    positions = index.query(genres, genre_mode, year_from, year_to, min_rating)
+    total = len(positions)
+    films = await run_db(get_films_by_ids, index.film_ids(positions, (page - 1) * FACET_PAGE_SIZE, FACET_PAGE_SIZE))
+    if page == 1 and total < FACET_FILL_MIN_RESULTS and _fillable(genres, year_from, year_to):
+        seen = {film["id"] for film in films}
+        extra = [f for f in await _fill_from_upstream(genres[0], year_from, year_to, min_rating) if f["id"] not in seen]
+        if extra:
+            logger.info("Фасетная выборка дополнена из апстрима: %s фильмов", len(extra))
+            # Новые фильмы уже записаны в каталог — в фасеты они попадут после перестройки индекса
+            mark_stale()
+            films += extra[:FACET_PAGE_SIZE - len(films)]
+            total += len(extra)
+    result = {"total": total, "films": films}
+    if with_facets:
+        result["facets"] = index.facet_counts(positions)
+    return result
+
+
+async def facet_counts(genres=(), genre_mode: str = "all", year_from=None, year_to=None, min_rating=None) -> dict:
+    index = await get_index()
+    return index.facet_counts(index.query(genres, genre_mode, year_from, year_to, min_rating))
+
+
+async def collection_films(user_id: str):
+    # -> (фильмы подборки, id, которые не нашлись ни в каталоге, ни у апстрима)
+    entries = await run_db(get_user_collection_films, user_id)
+    absent = [film_id for film_id, film in entries if film is None][:COLLECTION_HYDRATE_MAX]
+    hydrated = {}
+    if absent:
+        fetched = await asyncio.gather(*(get_film(film_id) for film_id in absent), return_exceptions=True)
+        for film_id, film in zip(absent, fetched):
+            if isinstance(film, Exception):
+                logger.warning("Фильм %s из подборки не загружен: %s", film_id, film)
+            elif film is not None:
+                hydrated[film_id] = film
+        if hydrated:
+            mark_stale()
+    films, missing = [], []
+    for film_id, film in entries:
+        film = film or hydrated.get(film_id)
+        if film is None:
+            missing.append(film_id)
+        else:
+            films.append(film)
+    return films, missing
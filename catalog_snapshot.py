@@ -0,0 +1,96 @@
+import time
+import asyncio
+import logging
+from database import run_db, get_catalog_candidates
+
+logger = logging.getLogger(__name__)
+
+
+def split_rows(rows):
+    # Строки get_catalog_candidates -> (ids, списки жанров, рейтинги, годы)
+    ids, genre_lists, ratings, years = [], [], [], []
+    for film_id, genres, rating, year in rows:
+        ids.append(film_id)
+        genre_lists.append(genres.split(",") if genres else [])
+        ratings.append(rating)
+        years.append(year)
+    return ids, genre_lists, ratings, years
+
+
+class CatalogRows:
+    # Одна выборка каталога на все снимки: грузится с наибольшим запрошенным лимитом,
+    # каждый снимок берёт свой префикс (выборка упорядочена по рейтингу)
+    def __init__(self):
+        self._rows = []
+        self._limit = 0
+        self._max_limit = 0
+        self._loaded_at = 0.0
+        self._task = None
+
+    async def get(self, limit: int, max_age: float) -> list:
+        self._max_limit = max(self._max_limit, limit)
+        while True:
+            if time.monotonic() - self._loaded_at <= max_age and self._limit >= limit:
+                return self._rows[:limit]
+            if self._task is None or self._task.done():
+                self._task = asyncio.ensure_future(self._load(self._max_limit))
+            # Идущая загрузка могла начаться с меньшим лимитом — тогда после неё грузим ещё раз
+            await asyncio.shield(self._task)
+
+    async def _load(self, limit: int):
+        rows = await run_db(get_catalog_candidates, limit)
+        self._rows, self._limit, self._loaded_at = rows, limit, time.monotonic()
+
+    def invalidate(self):
+        self._loaded_at = 0.0
+
+
+catalog_rows = CatalogRows()
+_snapshots = []
+
+
+class CatalogSnapshot:
+    # Структура поверх выборки каталога, перестраиваемая раз в refresh_seconds.
+    # build(rows) выполняется в отдельном потоке; пока строится новая, отдаётся прежняя
+    def __init__(self, name: str, build, max_films: int, refresh_seconds: float):
+        self.name = name
+        self.build = build
+        self.max_films = max_films
+        self.refresh_seconds = refresh_seconds
+        self.value = None
+        self._loaded_at = 0.0
+        self._refresh_task = None
+        _snapshots.append(self)
+
+    async def _refresh(self):
+        rows = await catalog_rows.get(self.max_films, self.refresh_seconds)
+        self.value = await asyncio.to_thread(self.build, rows)
+        self._loaded_at = time.monotonic()
+        logger.info("Снимок каталога '%s' обновлён: %s фильмов", self.name, len(self.value))
+        return self.value
+
+    def _log_refresh_error(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Ошибка обновления снимка каталога '%s': %s", self.name, task.exception())
+
+    async def get(self):
+        stale = time.monotonic() - self._loaded_at > self.refresh_seconds
+        if self.value is not None and not stale:
+            return self.value
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh())
+            self._refresh_task.add_done_callback(self._log_refresh_error)
+        if self.value is None:
+            return await asyncio.shield(self._refresh_task)
+        # Устаревший снимок отвечает сразу, новый соберётся в фоне
+        return self.value
+
+    def mark_stale(self):
+        self._loaded_at = 0.0
+
+
+def mark_stale():
+    # Каталог пополнился — при следующем запросе все снимки перестроятся в фоне
+    catalog_rows.invalidate()
+    for snapshot in _snapshots:
+        snapshot.mark_stale()
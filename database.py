@@ -1,96 +1,452 @@
 import sqlite3
 import os
+import time
+import queue
+import threading
+import asyncio
+import re
 import logging
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # Не POSIX: межпроцессной блокировки нет, несколько воркеров здесь и не запускаются
+    fcntl = None
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from metrics import db_query_duration
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Используем постоянное место для базы данных
-DB_PATH = "/app/data/film_app.db"
+DB_PATH = os.getenv("DB_PATH", "/app/data/film_app.db")
+
+# Пул соединений и потоков: запросы к SQLite не выполняются в event loop
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "20000"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+# sqlite3 кэширует подготовленные выражения по тексту SQL на каждом соединении
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+
+_pool = queue.LifoQueue()
+_pool_created = 0
+_pool_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+def _open_connection():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE,
+    )
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    return conn
+
+@contextmanager
+def _connection():
+    global _pool_created
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        with _pool_lock:
+            create = _pool_created < DB_POOL_SIZE
+            if create:
+                _pool_created += 1
+        conn = _open_connection() if create else _pool.get()
+    try:
+        # Контекст соединения делает commit, а при исключении — rollback
+        with conn:
+            yield conn
+    finally:
+        _pool.put(conn)
+
+def _timed(fn, args):
+    # Выполняется в потоке пула: время пишется в шард метрик этого потока
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        db_query_duration.observe(time.perf_counter() - start, (fn.__name__,))
+
+async def run_db(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, _timed, fn, args)
+
+def close_db():
+    global _pool_created
+    while True:
+        try:
+            _pool.get_nowait().close()
+        except queue.Empty:
+            break
+    _pool_created = 0
+
+# Показанные фильмы сессии хранятся одним BLOB: отсортированный массив uint32 без повторов
+SHOWN_FILMS_DTYPE = np.dtype("<u4")
+
+def pack_film_ids(film_ids) -> bytes:
+    return np.unique(np.asarray(film_ids, dtype=np.int64)).astype(SHOWN_FILMS_DTYPE).tobytes()
+
+def unpack_film_ids(blob) -> np.ndarray:
+    return np.frombuffer(blob or b"", dtype=SHOWN_FILMS_DTYPE)
+
+def _pack_shown_films(conn):
+    # Перенос session_shown_films (строка на фильм) в pair_sessions.shown_films
+    shown = {}
+    for session_id, film_id in conn.execute("SELECT session_id, film_id FROM session_shown_films"):
+        shown.setdefault(session_id, []).append(film_id)
+    conn.executemany("UPDATE pair_sessions SET shown_films = ? WHERE session_id = ?",
+                     [(pack_film_ids(film_ids), session_id) for session_id, film_ids in shown.items()])
+
+# Миграции схемы; номер применённой хранится в PRAGMA user_version.
+# Шаг миграции — SQL-выражение или функция от соединения (для переносов данных, которые не выразить в SQL)
+MIGRATIONS = [
+    # 1: индексы по user_id/session_id и уникальные ключи (дубликаты удаляем, голос оставляем последний)
+    [
+        "DELETE FROM user_collections WHERE rowid NOT IN (SELECT MIN(rowid) FROM user_collections GROUP BY user_id, film_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_user_collections_user_film ON user_collections (user_id, film_id)",
+        "DELETE FROM session_genres WHERE rowid NOT IN (SELECT MIN(rowid) FROM session_genres GROUP BY session_id, user_id, genre)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_session_genres_session_user_genre ON session_genres (session_id, user_id, genre)",
+        "DELETE FROM session_votes WHERE rowid NOT IN (SELECT MAX(rowid) FROM session_votes GROUP BY session_id, user_id, film_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_session_votes_session_user_film ON session_votes (session_id, user_id, film_id)",
+        "DELETE FROM session_shown_films WHERE rowid NOT IN (SELECT MIN(rowid) FROM session_shown_films GROUP BY session_id, film_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_session_shown_films_session_film ON session_shown_films (session_id, film_id)",
+    ],
+    # 2: полнотекстовый индекс названий (слова с префиксами) и триграммный индекс для опечаток.
+    # ё -> е сворачиваем сами: unicode61 не считает это диакритикой
+    [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS films_fts USING fts5(
+            name_ru, name_en, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+        )
+        """,
+        "CREATE VIRTUAL TABLE IF NOT EXISTS films_trigram USING fts5(name, tokenize = 'trigram')",
+        """
+        CREATE TRIGGER IF NOT EXISTS films_search_insert AFTER INSERT ON films BEGIN
+            INSERT INTO films_fts (rowid, name_ru, name_en)
+            VALUES (new.film_id, replace(replace(new.name_ru, 'ё', 'е'), 'Ё', 'Е'), new.name_en);
+            INSERT INTO films_trigram (rowid, name)
+            VALUES (new.film_id, replace(replace(coalesce(new.name_ru, '') || ' ' || coalesce(new.name_en, ''), 'ё', 'е'), 'Ё', 'Е'));
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS films_search_update AFTER UPDATE OF name_ru, name_en ON films
+        WHEN old.name_ru IS NOT new.name_ru OR old.name_en IS NOT new.name_en BEGIN
+            DELETE FROM films_fts WHERE rowid = old.film_id;
+            DELETE FROM films_trigram WHERE rowid = old.film_id;
+            INSERT INTO films_fts (rowid, name_ru, name_en)
+            VALUES (new.film_id, replace(replace(new.name_ru, 'ё', 'е'), 'Ё', 'Е'), new.name_en);
+            INSERT INTO films_trigram (rowid, name)
+            VALUES (new.film_id, replace(replace(coalesce(new.name_ru, '') || ' ' || coalesce(new.name_en, ''), 'ё', 'е'), 'Ё', 'Е'));
+        END
+        """,
+        """
+        INSERT INTO films_fts (rowid, name_ru, name_en)
+        SELECT film_id, replace(replace(name_ru, 'ё', 'е'), 'Ё', 'Е'), name_en FROM films
+        """,
+        """
+        INSERT INTO films_trigram (rowid, name)
+        SELECT film_id, replace(replace(coalesce(name_ru, '') || ' ' || coalesce(name_en, ''), 'ё', 'е'), 'Ё', 'Е') FROM films
+        """,
+    ],
+    # 3: кэш поиска персон и индекс персона -> фильмы
+    [
+        """
+        CREATE TABLE IF NOT EXISTS staff_names (
+            name_key TEXT PRIMARY KEY,
+            staff_ids TEXT NOT NULL,
+            resolved_at INTEGER NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS staff (
+            staff_id INTEGER PRIMARY KEY,
+            films_refreshed_at INTEGER NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS staff_films (
+            staff_id INTEGER NOT NULL,
+            film_id INTEGER NOT NULL,
+            PRIMARY KEY (staff_id, film_id)
+        ) WITHOUT ROWID
+        """,
+    ],
+    # 4: дисковый кэш постеров: файлы адресуются хешем содержимого, (фильм, размер) ссылается на хеш
+    [
+        """
+        CREATE TABLE IF NOT EXISTS poster_blobs (
+            digest TEXT PRIMARY KEY,
+            media_type TEXT NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            accessed_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_poster_blobs_accessed ON poster_blobs (accessed_at)",
+        """
+        CREATE TABLE IF NOT EXISTS posters (
+            film_id INTEGER NOT NULL,
+            variant TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            PRIMARY KEY (film_id, variant)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_posters_digest ON posters (digest)",
+    ],
+    # 5: совпадения фиксируются в базе (решение о совпадении принимает транзакция, а не память процесса)
+    # и общая лента событий сессий, которую читают все воркеры
+    [
+        """
+        CREATE TABLE IF NOT EXISTS session_matches (
+            session_id TEXT NOT NULL,
+            film_id INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            UNIQUE (session_id, film_id)
+        )
+        """,
+        """
+        INSERT OR IGNORE INTO session_matches (session_id, film_id, created_at)
+        SELECT session_id, film_id, 0 FROM session_votes
+        GROUP BY session_id, film_id
+        HAVING COUNT(DISTINCT user_id) = 2 AND MIN(vote) = 1
+        ORDER BY MIN(rowid)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS session_events (
+            event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_session_events_created ON session_events (created_at)",
+    ],
+    # 6: время жизни сессий и компактное хранение показанных фильмов. Существующим сессиям
+    # отсчёт TTL начинается с момента миграции
+    [
+        "ALTER TABLE pair_sessions ADD COLUMN created_at INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE pair_sessions ADD COLUMN last_active_at INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE pair_sessions ADD COLUMN shown_films BLOB",
+        """
+        UPDATE pair_sessions SET
+            created_at = CAST(strftime('%s', 'now') AS INTEGER),
+            last_active_at = CAST(strftime('%s', 'now') AS INTEGER)
+        """,
+        _pack_shown_films,
+        "DROP TABLE session_shown_films",
+        "CREATE INDEX IF NOT EXISTS idx_pair_sessions_last_active ON pair_sessions (last_active_at)",
+    ],
+]
+
+def _migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info("Применение миграции %s", number)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+@contextmanager
+def _init_lock():
+    # Воркеры стартуют одновременно: схему создаёт и мигрирует тот, кто первым взял блокировку,
+    # остальные ждут и видят по user_version, что делать уже нечего
+    if fcntl is None:
+        yield
+        return
+    with open(DB_PATH + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 def init_db():
+    with _init_lock():
+        conn = _open_connection()
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS):
+                logger.info("Схема базы данных актуальна")
+                return
+            _create_schema(conn)
+        finally:
+            conn.close()
+
+def _ensure_incremental_vacuum(conn):
+    # Режим auto_vacuum задаётся до создания таблиц; существующую базу переводим один раз через VACUUM.
+    # После этого освобождённые страницы возвращаются в ОС порциями через PRAGMA incremental_vacuum
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    logger.info("Перевод базы данных в режим auto_vacuum = INCREMENTAL")
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+def _create_schema(conn):
     logger.info("Инициализация базы данных")
-    with sqlite3.connect(DB_PATH) as conn:
+    _ensure_incremental_vacuum(conn)
+    # WAL сохраняется в файле базы: читатели не блокируют писателя
+    conn.execute("PRAGMA journal_mode = WAL")
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_collections (
+            user_id TEXT,
+            film_id INTEGER
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS pair_sessions (
+            session_id TEXT PRIMARY KEY,
+            user_a TEXT,
+            user_b TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS session_genres (
+            session_id TEXT,
+            user_id TEXT,
+            genre TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS session_votes (
+            session_id TEXT,
+            user_id TEXT,
+            film_id INTEGER,
+            vote BOOLEAN
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS session_shown_films (
+            session_id TEXT,
+            film_id INTEGER
+        )
+    """)
+    # Локальный каталог фильмов: всё, что когда-либо пришло от Кинопоиска
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS films (
+            film_id INTEGER PRIMARY KEY,
+            name_ru TEXT,
+            name_en TEXT,
+            description TEXT,
+            poster_url TEXT,
+            year INTEGER,
+            genres TEXT,
+            rating REAL,
+            type TEXT,
+            updated_at INTEGER
+        )
+    """)
+    conn.commit()
+    _migrate(conn)
+    logger.info("База данных инициализирована")
+
+def add_film_to_collection(user_id: str, film_id: int):
+    logger.debug("Добавление фильма %s пользователю %s", film_id, user_id)
+    with _connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS user_collections (
-                user_id TEXT,
-                film_id INTEGER
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS pair_sessions (
-                session_id TEXT PRIMARY KEY,
-                user_a TEXT,
-                user_b TEXT
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS session_genres (
-                session_id TEXT,
-                user_id TEXT,
-                genre TEXT
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS session_votes (
-                session_id TEXT,
-                user_id TEXT,
-                film_id INTEGER,
-                vote BOOLEAN
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS session_shown_films (
-                session_id TEXT,
-                film_id INTEGER
-            )
-        """)
+        cursor.execute("INSERT OR IGNORE INTO user_collections (user_id, film_id) VALUES (?, ?)", (user_id, film_id))
         conn.commit()
-        logger.info("База данных инициализирована")
+        logger.debug("Фильм %s успешно добавлен пользователю %s", film_id, user_id)
 
-def add_film_to_collection(user_id: str, film_id: int):
-    logger.info(f"Добавление фильма {film_id} пользователю {user_id}")
-    with sqlite3.connect(DB_PATH) as conn:
+def _existing_collection_ids(cursor, user_id: str, film_ids: list) -> set:
+    placeholders = ",".join("?" * len(film_ids))
+    cursor.execute(f"SELECT film_id FROM user_collections WHERE user_id = ? AND film_id IN ({placeholders})",
+                   [user_id, *film_ids])
+    return {row[0] for row in cursor.fetchall()}
+
+def add_films_to_collection(user_id: str, film_ids: list) -> dict:
+    logger.debug("Пакетное добавление %s фильмов пользователю %s", len(film_ids), user_id)
+    film_ids = list(dict.fromkeys(film_ids))
+    if not film_ids:
+        return {}
+    with _connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO user_collections (user_id, film_id) VALUES (?, ?)", (user_id, film_id))
+        # Одна транзакция на весь пакет; повторная отправка того же пакета ничего не меняет
+        existing = _existing_collection_ids(cursor, user_id, film_ids)
+        cursor.executemany("INSERT OR IGNORE INTO user_collections (user_id, film_id) VALUES (?, ?)",
+                           [(user_id, film_id) for film_id in film_ids if film_id not in existing])
         conn.commit()
-        logger.info(f"Фильм {film_id} успешно добавлен пользователю {user_id}")
+        logger.debug("Пользователю %s добавлено %s фильмов", user_id, len(film_ids) - len(existing))
+        return {film_id: "exists" if film_id in existing else "added" for film_id in film_ids}
+
+def get_collection_membership(user_id: str, film_ids: list) -> list:
+    logger.debug("Проверка %s фильмов в подборке пользователя %s", len(film_ids), user_id)
+    if not film_ids:
+        return []
+    with _connection() as conn:
+        existing = _existing_collection_ids(conn.cursor(), user_id, list(film_ids))
+        return [film_id for film_id in film_ids if film_id in existing]
 
 def get_user_collections(user_id: str) -> list:
-    logger.info(f"Получение подборки пользователя {user_id}")
-    with sqlite3.connect(DB_PATH) as conn:
+    logger.debug("Получение подборки пользователя %s", user_id)
+    with _connection() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT film_id FROM user_collections WHERE user_id = ?", (user_id,))
         rows = cursor.fetchall()
         result = [row[0] for row in rows]
-        logger.info(f"Найдено {len(result)} фильмов в подборке пользователя {user_id}")
+        logger.debug("Найдено %s фильмов в подборке пользователя %s", len(result), user_id)
         return result
 
 def create_pair_session(session_id: str, user_a: str, user_b: str):
-    logger.info(f"Создание сессии {session_id} между {user_a} и {user_b}")
-    with sqlite3.connect(DB_PATH) as conn:
+    logger.debug("Создание сессии %s между %s и %s", session_id, user_a, user_b)
+    now = int(time.time())
+    with _connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO pair_sessions (session_id, user_a, user_b) VALUES (?, ?, ?)",
-                       (session_id, user_a, user_b))
+        try:
+            cursor.execute("""
+                INSERT INTO pair_sessions (session_id, user_a, user_b, created_at, last_active_at) VALUES (?, ?, ?, ?, ?)
+            """, (session_id, user_a, user_b, now, now))
+        except sqlite3.IntegrityError:
+            raise SessionExists(session_id)
         conn.commit()
-        logger.info(f"Сессия {session_id} создана")
+        logger.debug("Сессия %s создана", session_id)
+
+class SessionNotFound(Exception):
+    def __init__(self, session_id: str):
+        super().__init__(f"Сессия {session_id} не найдена")
+        self.session_id = session_id
+
+class SessionExists(Exception):
+    def __init__(self, session_id: str):
+        super().__init__(f"Сессия {session_id} уже существует")
+        self.session_id = session_id
+
+def _touch_session(cursor, session_id: str):
+    # Любая запись в сессию продлевает её жизнь. Сессию могла удалить очистка истёкших, пока её
+    # состояние ещё жило в памяти воркера, — тогда запись отменяется, иначе строки осиротеют
+    cursor.execute("UPDATE pair_sessions SET last_active_at = ? WHERE session_id = ?", (int(time.time()), session_id))
+    if cursor.rowcount == 0:
+        raise SessionNotFound(session_id)
 
 def save_genres_for_user_in_session(session_id: str, user_id: str, genres: list):
-    logger.info(f"Сохранение жанров {genres} для пользователя {user_id} в сессии {session_id}")
-    with sqlite3.connect(DB_PATH) as conn:
+    logger.debug("Сохранение %s жанров для пользователя %s в сессии %s", len(genres), user_id, session_id)
+    with _connection() as conn:
         cursor = conn.cursor()
+        _touch_session(cursor, session_id)
         cursor.execute("DELETE FROM session_genres WHERE session_id = ? AND user_id = ?", (session_id, user_id))
-        for genre in genres:
-            cursor.execute("INSERT INTO session_genres (session_id, user_id, genre) VALUES (?, ?, ?)",
-                           (session_id, user_id, genre))
+        cursor.executemany("INSERT OR IGNORE INTO session_genres (session_id, user_id, genre) VALUES (?, ?, ?)",
+                           [(session_id, user_id, genre) for genre in genres])
         conn.commit()
-        logger.info(f"Жанры сохранены для пользователя {user_id} в сессии {session_id}")
+        logger.debug("Жанры сохранены для пользователя %s в сессии %s", user_id, session_id)
 
 def get_genres_for_users_in_session(session_id: str):
-    logger.info(f"Получение жанров для сессии {session_id}")
-    with sqlite3.connect(DB_PATH) as conn:
+    logger.debug("Получение жанров для сессии %s", session_id)
+    with _connection() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT user_id, genre FROM session_genres WHERE session_id = ?", (session_id,))
         rows = cursor.fetchall()
@@ -99,59 +455,451 @@ def get_genres_for_users_in_session(session_id: str):
             if user_id not in user_genres:
                 user_genres[user_id] = []
             user_genres[user_id].append(genre)
-        logger.info(f"Жанры для сессии {session_id}: {user_genres}")
+        logger.debug("Жанры для сессии %s: %s участников", session_id, len(user_genres))
         return user_genres
 
-def save_vote_in_session(session_id: str, user_id: str, film_id: int, vote: bool):
-    logger.info(f"Сохранение голоса пользователя {user_id} за фильм {film_id} в сессии {session_id}: {vote}")
-    with sqlite3.connect(DB_PATH) as conn:
+def get_users_in_session(session_id: str):
+    logger.debug("Получение пользователей для сессии %s", session_id)
+    with _connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_a, user_b FROM pair_sessions WHERE session_id = ?", (session_id,))
+        row = cursor.fetchone()
+        if row:
+            logger.debug("Пользователи в сессии %s: %s, %s", session_id, row[0], row[1])
+            return row[0], row[1]
+        logger.debug("Сессия %s не найдена", session_id)
+        return None, None
+
+def save_votes_in_session(session_id: str, votes: list):
+    # Один воркер: совпадения считает индекс в памяти, в базу голоса пишутся без блокировки и чтений
+    logger.debug("Пакетное сохранение %s голосов в сессии %s", len(votes), session_id)
+    if not votes:
+        return
+    with _connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("INSERT OR REPLACE INTO session_votes (session_id, user_id, film_id, vote) VALUES (?, ?, ?, ?)",
-                       (session_id, user_id, film_id, vote))
+        _touch_session(cursor, session_id)
+        cursor.executemany("""
+            INSERT INTO session_votes (session_id, user_id, film_id, vote) VALUES (?, ?, ?, ?)
+            ON CONFLICT(session_id, user_id, film_id) DO UPDATE SET vote = excluded.vote
+        """, [(session_id, user_id, film_id, vote) for user_id, film_id, vote in votes])
+        conn.commit()
+
+def save_session_matches(session_id: str, film_ids: list):
+    now = int(time.time())
+    with _connection() as conn:
+        conn.executemany("INSERT OR IGNORE INTO session_matches (session_id, film_id, created_at) VALUES (?, ?, ?)",
+                         [(session_id, film_id, now) for film_id in film_ids])
         conn.commit()
-        logger.info(f"Голос сохранён")
 
-def get_votes_in_session(session_id: str):
-    logger.info(f"Получение голосов для сессии {session_id}")
-    with sqlite3.connect(DB_PATH) as conn:
+def get_votes_in_session(session_id: str) -> dict:
+    # -> {user_id: {film_id: vote}}
+    with _connection() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT user_id, film_id, vote FROM session_votes WHERE session_id = ?", (session_id,))
-        rows = cursor.fetchall()
         votes = {}
-        for user_id, film_id, vote in rows:
-            if user_id not in votes:
-                votes[user_id] = {}
-            votes[user_id][film_id] = vote
-        logger.info(f"Голоса для сессии {session_id}: {votes}")
+        for user_id, film_id, vote in cursor.fetchall():
+            votes.setdefault(user_id, {})[film_id] = bool(vote)
         return votes
 
-def get_users_in_session(session_id: str):
-    logger.info(f"Получение пользователей для сессии {session_id}")
-    with sqlite3.connect(DB_PATH) as conn:
+def _film_votes(cursor, session_id: str, film_ids: list) -> dict:
+    placeholders = ",".join("?" * len(film_ids))
+    cursor.execute(f"SELECT film_id, user_id, vote FROM session_votes WHERE session_id = ? AND film_id IN ({placeholders})",
+                   [session_id, *film_ids])
+    result = {}
+    for film_id, user_id, vote in cursor.fetchall():
+        result.setdefault(film_id, {})[user_id] = bool(vote)
+    return result
+
+def record_votes(session_id: str, users: tuple, votes: list) -> dict:
+    # Голоса и решение о совпадении — в одной транзакции с блокировкой записи: при нескольких
+    # воркерах каждое совпадение фиксирует ровно один из них.
+    # -> {film_id: {"matched": совпадение создано сейчас, "completed": этим вызовом проголосовал последний участник}}
+    logger.debug("Запись %s голосов в сессии %s", len(votes), session_id)
+    if not votes:
+        return {}
+    film_ids = sorted({film_id for _, film_id, _ in votes})
+    with _connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT user_a, user_b FROM pair_sessions WHERE session_id = ?", (session_id,))
-        row = cursor.fetchone()
-        if row:
-            logger.info(f"Пользователи в сессии {session_id}: {row[0]}, {row[1]}")
-            return row[0], row[1]
-        logger.info(f"Сессия {session_id} не найдена")
-        return None, None
+        cursor.execute("BEGIN IMMEDIATE")
+        _touch_session(cursor, session_id)
+        before = _film_votes(cursor, session_id, film_ids)
+        cursor.executemany("""
+            INSERT INTO session_votes (session_id, user_id, film_id, vote) VALUES (?, ?, ?, ?)
+            ON CONFLICT(session_id, user_id, film_id) DO UPDATE SET vote = excluded.vote
+        """, [(session_id, user_id, film_id, vote) for user_id, film_id, vote in votes])
+        after = _film_votes(cursor, session_id, film_ids)
+        now = int(time.time())
+        result = {}
+        for film_id in film_ids:
+            film_votes = after.get(film_id, {})
+            matched = False
+            if all(film_votes.get(user) for user in users):
+                cursor.execute("INSERT OR IGNORE INTO session_matches (session_id, film_id, created_at) VALUES (?, ?, ?)",
+                               (session_id, film_id, now))
+                matched = cursor.rowcount == 1
+            result[film_id] = {
+                "matched": matched,
+                "completed": len(before.get(film_id, {})) < len(users) <= len(film_votes),
+            }
+        conn.commit()
+        return result
+
+def get_session_matches(session_id: str) -> list:
+    with _connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT film_id FROM session_matches WHERE session_id = ? ORDER BY rowid", (session_id,))
+        return [row[0] for row in cursor.fetchall()]
+
+def save_session_event(session_id: str, payload: str):
+    with _connection() as conn:
+        conn.execute("INSERT INTO session_events (session_id, payload, created_at) VALUES (?, ?, ?)",
+                     (session_id, payload, int(time.time())))
+        conn.commit()
+
+def get_last_session_event_id() -> int:
+    with _connection() as conn:
+        return conn.execute("SELECT COALESCE(MAX(event_id), 0) FROM session_events").fetchone()[0]
+
+def get_session_events_after(event_id: int, limit: int) -> list:
+    with _connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT event_id, session_id, payload FROM session_events WHERE event_id > ? ORDER BY event_id LIMIT ?",
+                       (event_id, limit))
+        return cursor.fetchall()
+
+def delete_session_events_before(timestamp: int) -> int:
+    with _connection() as conn:
+        cursor = conn.execute("DELETE FROM session_events WHERE created_at < ?", (timestamp,))
+        conn.commit()
+        return cursor.rowcount
 
 def add_shown_film_to_session(session_id: str, film_id: int):
-    logger.info(f"Добавление показанного фильма {film_id} в сессии {session_id}")
-    with sqlite3.connect(DB_PATH) as conn:
+    logger.debug("Добавление показанного фильма %s в сессии %s", film_id, session_id)
+    with _connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO session_shown_films (session_id, film_id) VALUES (?, ?)",
-                       (session_id, film_id))
+        # Чтение и запись массива — под блокировкой записи, чтобы воркеры не теряли добавления друг друга
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT shown_films FROM pair_sessions WHERE session_id = ?", (session_id,))
+        row = cursor.fetchone()
+        if row is None:
+            raise SessionNotFound(session_id)
+        shown = unpack_film_ids(row[0])
+        position = int(np.searchsorted(shown, film_id))
+        if position == len(shown) or shown[position] != film_id:
+            shown = np.insert(shown, position, film_id)
+        cursor.execute("UPDATE pair_sessions SET shown_films = ?, last_active_at = ? WHERE session_id = ?",
+                       (shown.tobytes(), int(time.time()), session_id))
         conn.commit()
-        logger.info(f"Фильм {film_id} добавлен в показанные для сессии {session_id}")
+        logger.debug("Фильм %s добавлен в показанные для сессии %s", film_id, session_id)
 
-def get_shown_films_in_session(session_id: str):
-    logger.info(f"Получение показанных фильмов для сессии {session_id}")
-    with sqlite3.connect(DB_PATH) as conn:
+def get_shown_films_in_session(session_id: str) -> np.ndarray:
+    # Одна строка по первичному ключу и без разбора: массив читается прямо из BLOB
+    with _connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT film_id FROM session_shown_films WHERE session_id = ?", (session_id,))
-        rows = cursor.fetchall()
-        result = [row[0] for row in rows]
-        logger.info(f"Показанные фильмы в сессии {session_id}: {result}")
-        return result
\ No newline at end of file
+        cursor.execute("SELECT shown_films FROM pair_sessions WHERE session_id = ?", (session_id,))
+        row = cursor.fetchone()
+        result = unpack_film_ids(row[0] if row else None)
+        logger.debug("Показанные фильмы в сессии %s: %s", session_id, len(result))
+        return result
+
+def delete_expired_sessions(inactive_before: int, limit: int, expired_event: str = None) -> list:
+    # Пачка сессий без активности с inactive_before удаляется вместе со всеми данными одной транзакцией.
+    # expired_event — событие, которое та же транзакция кладёт в ленту каждой удалённой сессии,
+    # чтобы все воркеры забыли её состояние
+    with _connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT session_id FROM pair_sessions WHERE last_active_at < ? ORDER BY last_active_at LIMIT ?",
+                       (inactive_before, limit))
+        session_ids = [row[0] for row in cursor.fetchall()]
+        if not session_ids:
+            return []
+        placeholders = ",".join("?" * len(session_ids))
+        for table in ("session_genres", "session_votes", "session_matches", "session_events", "pair_sessions"):
+            cursor.execute(f"DELETE FROM {table} WHERE session_id IN ({placeholders})", session_ids)
+        if expired_event is not None:
+            now = int(time.time())
+            cursor.executemany("INSERT INTO session_events (session_id, payload, created_at) VALUES (?, ?, ?)",
+                               [(session_id, expired_event, now) for session_id in session_ids])
+        conn.commit()
+        logger.debug("Удалено %s истёкших сессий", len(session_ids))
+        return session_ids
+
+def incremental_vacuum(pages: int) -> int:
+    # Возвращает ОС до pages свободных страниц; -> сколько вернули
+    with _connection() as conn:
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        # PRAGMA incremental_vacuum работает по шагам — выбираем результат до конца
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+# Upsert не затирает уже известные поля пустыми значениями из неполных ответов апстрима
+FILM_UPSERT_SQL = """
+    INSERT INTO films (film_id, name_ru, name_en, description, poster_url, year, genres, rating, type, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(film_id) DO UPDATE SET
+        name_ru = COALESCE(excluded.name_ru, films.name_ru),
+        name_en = COALESCE(excluded.name_en, films.name_en),
+        description = COALESCE(excluded.description, films.description),
+        poster_url = COALESCE(NULLIF(excluded.poster_url, ''), films.poster_url),
+        year = COALESCE(excluded.year, films.year),
+        genres = COALESCE(NULLIF(excluded.genres, ''), films.genres),
+        rating = COALESCE(excluded.rating, films.rating),
+        type = COALESCE(excluded.type, films.type),
+        updated_at = excluded.updated_at
+"""
+
+FILM_COLUMNS = "f.film_id, f.name_ru, f.name_en, f.description, f.poster_url, f.year, f.genres, f.rating"
+
+# В ответах вместо ссылки на CDN Кинопоиска можно отдавать адрес собственного прокси постеров (/posters/{id})
+POSTER_PROXY_URLS = os.getenv("POSTER_PROXY_URLS", "0") == "1"
+POSTER_PUBLIC_BASE_URL = os.getenv("POSTER_PUBLIC_BASE_URL", "").rstrip("/")
+POSTER_URL_SIZE = os.getenv("POSTER_URL_SIZE", "medium")
+
+def public_poster_url(film_id: int, upstream_url) -> str:
+    if not upstream_url:
+        return ""
+    if not POSTER_PROXY_URLS:
+        return upstream_url
+    return f"{POSTER_PUBLIC_BASE_URL}/posters/{film_id}?size={POSTER_URL_SIZE}"
+
+def _film_from_row(row) -> dict:
+    film_id, name_ru, name_en, description, poster_url, year, genres, rating = row
+    return {
+        "id": film_id,
+        "name": name_ru or name_en or "Без названия",
+        "description": description or "Описание отсутствует",
+        "posterUrl": public_poster_url(film_id, poster_url),
+        "year": year,
+        "genre": genres.split(",")[0] if genres else None,
+        "rating": rating
+    }
+
+def save_films(films: list):
+    if not films:
+        return
+    now = int(time.time())
+    rows = [
+        (f["id"], f.get("name_ru"), f.get("name_en"), f.get("description"), f.get("poster_url"),
+         f.get("year"), ",".join(f.get("genres") or []), f.get("rating"), f.get("type"), now)
+        for f in films
+    ]
+    logger.debug("Сохранение %s фильмов в каталог", len(rows))
+    with _connection() as conn:
+        conn.executemany(FILM_UPSERT_SQL, rows)
+        conn.commit()
+
+def get_user_collection_films(user_id: str) -> list:
+    # -> [(film_id, фильм или None)] в порядке добавления; None — фильма ещё нет в каталоге
+    logger.debug("Получение фильмов подборки пользователя %s из каталога", user_id)
+    with _connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT uc.film_id, {FILM_COLUMNS}
+            FROM user_collections uc
+            LEFT JOIN films f ON f.film_id = uc.film_id
+            WHERE uc.user_id = ?
+            ORDER BY uc.rowid
+        """, (user_id,))
+        result = [(row[0], _film_from_row(row[1:]) if row[1] is not None else None) for row in cursor.fetchall()]
+        logger.debug("Подборка пользователя %s: %s фильмов", user_id, len(result))
+        return result
+
+def get_films_by_ids(film_ids: list) -> list:
+    if not film_ids:
+        return []
+    logger.debug("Получение %s фильмов из каталога", len(film_ids))
+    placeholders = ",".join("?" * len(film_ids))
+    with _connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {FILM_COLUMNS} FROM films f WHERE f.film_id IN ({placeholders})", list(film_ids))
+        by_id = {row[0]: _film_from_row(row) for row in cursor.fetchall()}
+        # Сохраняем порядок запрошенных id
+        return [by_id[film_id] for film_id in film_ids if film_id in by_id]
+
+def get_catalog_candidates(limit: int) -> list:
+    logger.debug("Загрузка до %s кандидатов из каталога", limit)
+    with _connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT film_id, genres, rating, year
+            FROM films
+            ORDER BY rating IS NULL, rating DESC
+            LIMIT ?
+        """, (limit,))
+        return cursor.fetchall()
+
+# Порог похожести (коэффициент Жаккара по триграммам) для нечёткого поиска
+TITLE_FUZZY_THRESHOLD = float(os.getenv("TITLE_FUZZY_THRESHOLD", "0.3"))
+TITLE_FUZZY_CANDIDATES = int(os.getenv("TITLE_FUZZY_CANDIDATES", "200"))
+
+_WORD_RE = re.compile(r"\w+")
+
+def fold_text(text: str) -> str:
+    return text.casefold().replace("ё", "е")
+
+def _word_trigrams(word: str) -> set:
+    padded = f" {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _title_similarity(query_words: list, name: str) -> float:
+    # Для каждого слова запроса берём самое похожее слово названия и усредняем
+    name_words = [_word_trigrams(w) for w in _WORD_RE.findall(fold_text(name))]
+    if not name_words:
+        return 0.0
+    total = 0.0
+    for word in query_words:
+        grams = _word_trigrams(word)
+        total += max(len(grams & other) / len(grams | other) for other in name_words)
+    return total / len(query_words)
+
+def _search_titles_fts(cursor, words: list, limit: int) -> list:
+    # Каждое слово — префикс, все слова должны встретиться в названии
+    query = " ".join(f'"{word}"*' for word in words)
+    cursor.execute("SELECT rowid FROM films_fts WHERE films_fts MATCH ? ORDER BY rank LIMIT ?", (query, limit))
+    return [row[0] for row in cursor.fetchall()]
+
+def _search_titles_fuzzy(cursor, words: list, limit: int) -> list:
+    # Внутренние триграммы слов (без краёв с пробелами) — кандидаты из индекса, точная оценка в Python
+    query_trigrams = {t for word in words for t in _word_trigrams(word) if " " not in t}
+    if not query_trigrams:
+        return []
+    query = " OR ".join(f'"{t}"' for t in query_trigrams)
+    cursor.execute("SELECT rowid, name FROM films_trigram WHERE films_trigram MATCH ? ORDER BY rank LIMIT ?",
+                   (query, TITLE_FUZZY_CANDIDATES))
+    scored = []
+    for film_id, name in cursor.fetchall():
+        similarity = _title_similarity(words, name)
+        if similarity >= TITLE_FUZZY_THRESHOLD:
+            scored.append((-similarity, len(name), film_id))
+    scored.sort()
+    return [film_id for _, _, film_id in scored[:limit]]
+
+def search_titles_local(title: str, limit: int = 20) -> list:
+    logger.debug("Локальный поиск по названию: '%s'", title)
+    words = _WORD_RE.findall(fold_text(title))
+    if not words:
+        return []
+    with _connection() as conn:
+        cursor = conn.cursor()
+        film_ids = _search_titles_fts(cursor, words, limit)
+        if len(film_ids) < limit:
+            # Опечатки: добираем похожие по триграммам
+            seen = set(film_ids)
+            film_ids += [i for i in _search_titles_fuzzy(cursor, words, limit) if i not in seen][:limit - len(film_ids)]
+    result = get_films_by_ids(film_ids)
+    logger.debug("Локально найдено %s фильмов по названию", len(result))
+    return result
+
+def get_staff_resolution(name_key: str):
+    with _connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT staff_ids, resolved_at FROM staff_names WHERE name_key = ?", (name_key,))
+        row = cursor.fetchone()
+        if not row:
+            return None, None
+        return [int(i) for i in row[0].split(",") if i], row[1]
+
+def save_staff_resolution(name_key: str, staff_ids: list):
+    logger.debug("Сохранение %s персон для имени '%s'", len(staff_ids), name_key)
+    with _connection() as conn:
+        conn.execute("""
+            INSERT INTO staff_names (name_key, staff_ids, resolved_at) VALUES (?, ?, ?)
+            ON CONFLICT(name_key) DO UPDATE SET staff_ids = excluded.staff_ids, resolved_at = excluded.resolved_at
+        """, (name_key, ",".join(str(i) for i in staff_ids), int(time.time())))
+        conn.commit()
+
+def get_staff_refreshed_at(staff_ids: list) -> dict:
+    if not staff_ids:
+        return {}
+    placeholders = ",".join("?" * len(staff_ids))
+    with _connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT staff_id, films_refreshed_at FROM staff WHERE staff_id IN ({placeholders})", list(staff_ids))
+        return dict(cursor.fetchall())
+
+def save_staff_films(staff_id: int, film_ids: list):
+    logger.debug("Сохранение %s фильмов персоны %s", len(film_ids), staff_id)
+    with _connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM staff_films WHERE staff_id = ?", (staff_id,))
+        cursor.executemany("INSERT OR IGNORE INTO staff_films (staff_id, film_id) VALUES (?, ?)",
+                           [(staff_id, film_id) for film_id in film_ids])
+        cursor.execute("""
+            INSERT INTO staff (staff_id, films_refreshed_at) VALUES (?, ?)
+            ON CONFLICT(staff_id) DO UPDATE SET films_refreshed_at = excluded.films_refreshed_at
+        """, (staff_id, int(time.time())))
+        conn.commit()
+
+def get_films_for_staff(staff_ids: list) -> list:
+    logger.debug("Получение фильмов %s персон из каталога", len(staff_ids))
+    if not staff_ids:
+        return []
+    placeholders = ",".join("?" * len(staff_ids))
+    with _connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT DISTINCT {FILM_COLUMNS}
+            FROM staff_films sf
+            JOIN films f ON f.film_id = sf.film_id
+            WHERE sf.staff_id IN ({placeholders})
+            ORDER BY f.rating IS NULL, f.rating DESC
+        """, list(staff_ids))
+        result = [_film_from_row(row) for row in cursor.fetchall()]
+        logger.debug("Найдено %s фильмов персон в каталоге", len(result))
+        return result
+
+def get_poster_source(film_id: int):
+    with _connection() as conn:
+        row = conn.execute("SELECT poster_url FROM films WHERE film_id = ?", (film_id,)).fetchone()
+        return row[0] if row else None
+
+def get_poster(film_id: int, variant: str):
+    with _connection() as conn:
+        row = conn.execute("""
+            SELECT b.digest, b.media_type, b.accessed_at
+            FROM posters p JOIN poster_blobs b ON b.digest = p.digest
+            WHERE p.film_id = ? AND p.variant = ?
+        """, (film_id, variant)).fetchone()
+        return row
+
+def touch_poster_blob(digest: str):
+    with _connection() as conn:
+        conn.execute("UPDATE poster_blobs SET accessed_at = ? WHERE digest = ?", (int(time.time()), digest))
+        conn.commit()
+
+def save_poster(film_id: int, variant: str, digest: str, media_type: str, size_bytes: int):
+    logger.debug("Сохранение постера %s (%s) в кэш: %s байт", film_id, variant, size_bytes)
+    with _connection() as conn:
+        conn.execute("""
+            INSERT INTO poster_blobs (digest, media_type, size_bytes, accessed_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(digest) DO UPDATE SET accessed_at = excluded.accessed_at
+        """, (digest, media_type, size_bytes, int(time.time())))
+        conn.execute("""
+            INSERT INTO posters (film_id, variant, digest) VALUES (?, ?, ?)
+            ON CONFLICT(film_id, variant) DO UPDATE SET digest = excluded.digest
+        """, (film_id, variant, digest))
+        conn.commit()
+
+def evict_poster_blobs(max_bytes: int, keep: str = None) -> list:
+    # Самые давно запрошенные файлы удаляются, пока кэш не уложится в max_bytes; возвращает их хеши.
+    # keep — только что сохранённый файл: его отдаём прямо сейчас, вытеснять нельзя
+    with _connection() as conn:
+        cursor = conn.cursor()
+        total = cursor.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM poster_blobs").fetchone()[0]
+        if total <= max_bytes:
+            return []
+        evicted = []
+        candidates = cursor.execute(
+            "SELECT digest, size_bytes FROM poster_blobs WHERE digest IS NOT ? ORDER BY accessed_at", (keep,)
+        ).fetchall()
+        for digest, size_bytes in candidates:
+            if total <= max_bytes:
+                break
+            evicted.append(digest)
+            total -= size_bytes
+        cursor.executemany("DELETE FROM posters WHERE digest = ?", [(d,) for d in evicted])
+        cursor.executemany("DELETE FROM poster_blobs WHERE digest = ?", [(d,) for d in evicted])
+        conn.commit()
+        logger.info("Из кэша постеров вытеснено %s файлов", len(evicted))
+        return evicted
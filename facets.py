@@ -0,0 +1,115 @@
+import os
+import math
+import numpy as np
+from catalog_snapshot import CatalogSnapshot, split_rows
+
+FACET_MAX_FILMS = int(os.getenv("FACET_MAX_FILMS", "200000"))
+FACET_REFRESH_SECONDS = float(os.getenv("FACET_REFRESH_SECONDS", "60"))
+
+EMPTY = np.empty(0, dtype=np.int32)
+
+
+class FacetIndex:
+    # Инвертированный индекс по каталогу. Фильм задаётся позицией в выборке каталога, а выборка
+    # упорядочена по рейтингу — поэтому отсортированный список позиций уже отсортирован по рейтингу.
+    # Списки позиций (postings) — отсортированные int32-массивы, фильтры — их пересечения.
+    def __init__(self, ids, genre_lists, ratings, years):
+        self.ids = np.asarray(ids, dtype=np.int64)
+
+        names = {}
+        for genres in genre_lists:
+            for g in genres:
+                names.setdefault(g.casefold(), g)
+        self.genre_names = names
+        genre_positions = {key: [] for key in names}
+        for position, genres in enumerate(genre_lists):
+            for key in {g.casefold() for g in genres}:
+                genre_positions[key].append(position)
+        self.genre_postings = {key: np.asarray(p, dtype=np.int32) for key, p in genre_positions.items()}
+        self.genre_keys = sorted(names)
+
+        # Год: позиции, упорядоченные по году, — диапазон лет это срез, найденный бинарным поиском
+        self.years = np.array([y or 0 for y in years], dtype=np.int32)
+        self.year_order = np.argsort(self.years, kind="stable").astype(np.int32)
+        self.sorted_years = self.years[self.year_order]
+
+        # Рейтинг: корзины по целой части (0..10), неизвестный рейтинг — корзина -1
+        self.ratings = np.array([r if r is not None else np.nan for r in ratings], dtype=np.float32)
+        self.rating_buckets = np.where(np.isnan(self.ratings), -1, np.floor(np.nan_to_num(self.ratings))).astype(np.int8)
+        self.rating_postings = {
+            int(bucket): np.flatnonzero(self.rating_buckets == bucket).astype(np.int32)
+            for bucket in np.unique(self.rating_buckets)
+        }
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _genre_positions(self, genres, mode: str):
+        postings = [self.genre_postings.get(g.casefold(), EMPTY) for g in genres]
+        if mode == "any":
+            return np.unique(np.concatenate(postings))
+        return postings
+
+    def _year_positions(self, year_from, year_to):
+        # Фильмы без года (0) в диапазон не попадают
+        low = np.searchsorted(self.sorted_years, max(year_from or 1, 1), side="left")
+        high = np.searchsorted(self.sorted_years, year_to, side="right") if year_to is not None else len(self.sorted_years)
+        return np.sort(self.year_order[low:high])
+
+    def _rating_positions(self, min_rating: float):
+        # Корзины целиком выше порога берём как есть, пограничную дочищаем точным сравнением
+        first = math.floor(min_rating)
+        postings = [p for bucket, p in self.rating_postings.items() if bucket >= first]
+        if not postings:
+            return EMPTY
+        positions = np.sort(np.concatenate(postings))
+        return positions[self.ratings[positions] >= min_rating]
+
+    def query(self, genres=(), genre_mode: str = "all", year_from=None, year_to=None, min_rating=None) -> np.ndarray:
+        sets = []
+        if genres:
+            found = self._genre_positions(genres, genre_mode)
+            sets.extend(found if isinstance(found, list) else [found])
+        if year_from is not None or year_to is not None:
+            sets.append(self._year_positions(year_from, year_to))
+        if min_rating is not None:
+            sets.append(self._rating_positions(min_rating))
+        if not sets:
+            return np.arange(len(self.ids), dtype=np.int32)
+        # Пересекаем от самого короткого списка: каждый следующий шаг дешевле
+        sets.sort(key=len)
+        result = sets[0]
+        for other in sets[1:]:
+            if not len(result):
+                break
+            result = np.intersect1d(result, other, assume_unique=True)
+        return result
+
+    def film_ids(self, positions, offset: int = 0, limit: int = None) -> list:
+        end = None if limit is None else offset + limit
+        return [int(i) for i in self.ids[positions[offset:end]]]
+
+    def facet_counts(self, positions) -> dict:
+        # Жанры: маска результата и выборка по каждому списку позиций — без матрицы фильм x жанр
+        mask = np.zeros(len(self.ids), dtype=bool)
+        mask[positions] = True
+        genre_counts = [np.count_nonzero(mask[self.genre_postings[k]]) for k in self.genre_keys]
+        years, year_counts = np.unique(self.years[positions], return_counts=True)
+        buckets, bucket_counts = np.unique(self.rating_buckets[positions], return_counts=True)
+        # Ключи строками — так они и уйдут в JSON
+        return {
+            "genres": {self.genre_names[k]: int(c) for k, c in zip(self.genre_keys, genre_counts) if c},
+            "years": {str(int(y)): int(c) for y, c in zip(years, year_counts) if y},
+            "ratings": {str(int(b)): int(c) for b, c in zip(buckets, bucket_counts) if b >= 0},
+        }
+
+
+def build_index(rows) -> FacetIndex:
+    return FacetIndex(*split_rows(rows))
+
+
+index_snapshot = CatalogSnapshot("фасетный индекс", build_index, FACET_MAX_FILMS, FACET_REFRESH_SECONDS)
+
+
+async def get_index() -> FacetIndex:
+    return await index_snapshot.get()
@@ -0,0 +1,49 @@
+import hashlib
+import orjson
+from fastapi import Request
+from fastapi.responses import Response
+
+# Клиент всё равно переспрашивает сервер, но при совпадении ETag получает пустой 304
+CACHE_CONTROL = "no-cache"
+
+
+def encode(value) -> bytes:
+    return orjson.dumps(value)
+
+
+def make_etag(body: bytes) -> str:
+    # Сильный ETag: хеш от точных байтов тела
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    # Для If-None-Match действует слабое сравнение: префикс W/ не учитывается
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def bytes_response(request: Request, body: bytes, etag: str = None) -> Response:
+    if etag is None:
+        return Response(content=body, media_type="application/json")
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def json_response(request: Request, value, etag: bool = True) -> Response:
+    # Данные собраны нами же из проверенных полей — повторная валидация через response_model не нужна
+    body = encode(value)
+    return bytes_response(request, body, make_etag(body) if etag else None)
+
+
+def entry_response(request: Request, entry) -> Response:
+    # Тело и ETag считаются один раз на запись кэша и переиспользуются до её замены
+    if entry.body is None:
+        entry.body = encode(entry.value)
+        entry.etag = make_etag(entry.body)
+    return bytes_response(request, entry.body, entry.etag)
@@ -1,190 +1,177 @@
-import requests
 import os
 import logging
+from kinopoisk_client import get_json, KinopoiskError
+from cache import cached
+from database import save_films, run_db, public_poster_url
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Используем переменную окружения для API-ключа
-KINOPOISK_API_KEY = os.getenv("KINOPOISK_API_KEY", "H974FM6-0V3M4CP-HNA5Q7V-ARMKP1B")  # Временно, потом удалите
-if not KINOPOISK_API_KEY:
-    raise ValueError("Не установлен API-ключ KINOPOISK_API_KEY")
-
-def search_films(params):
-    logger.info(f"Отправляем запрос к API Кинопоиска с параметрами: {params}")
-    headers = {"X-API-KEY": KINOPOISK_API_KEY}
-    response = requests.get("https://kinopoiskapiunofficial.tech/api/v2.2/films", headers=headers, params=params)
-    logger.info(f"Ответ от API: статус {response.status_code}, длина {len(response.content)} байт")
-    if response.status_code != 200:
-        logger.error(f"Ошибка API: {response.status_code}, текст: {response.text}")
-        raise Exception(f"API error {response.status_code}: {response.text}")
-    return response.json()
-
-def get_random_series():
-    logger.info("Запрос: получить 5 случайных сериалов")
-    params = [
-        ("field", "type"),
-        ("value", "TV_SERIES"),
-        ("ratingFrom", 0),
-        ("ratingTo", 10),
-        ("yearFrom", 1950),
-        ("yearTo", 2026),
-        ("isSerial", True),
-        ("page", 1)
-    ]
+# TTL кэша (секунды) для каждого эндпоинта
+CACHE_TTL_GENRE_YEAR = float(os.getenv("CACHE_TTL_GENRE_YEAR", "3600"))
+CACHE_TTL_TITLE = float(os.getenv("CACHE_TTL_TITLE", "900"))
+# Страницы для пулов случайной выдачи: содержимое страницы стабильно, а при нескольких воркерах
+# через общий кэш каждая страница запрашивается у апстрима один раз на всех
+CACHE_TTL_RANDOM_PAGE = float(os.getenv("CACHE_TTL_RANDOM_PAGE", "3600"))
+# Карточки фильмов по id: найденные сразу пишутся в каталог, так что кэш в основном хранит
+# отрицательные ответы — несуществующий id из подборки не тратит квоту на каждом чтении
+CACHE_TTL_FILM = float(os.getenv("CACHE_TTL_FILM", str(24 * 3600)))
+
+class FilmPage(list):
+    # Страница выдачи апстрима: сам список фильмов плюс число страниц (None — неизвестно).
+    # last_page — последняя использованная страница апстрима, если она не совпадает с запрошенной;
+    # cursor_state — дополнительные поля курсора следующей страницы
+    def __init__(self, films=(), pages=None, last_page=None, cursor_state=None):
+        super().__init__(films)
+        self.pages = pages
+        self.last_page = last_page
+        self.cursor_state = cursor_state or {}
+
+def _pages_count(data):
+    return data.get("pagesCount") or data.get("totalPages")
+
+async def search_films(params):
+    logger.debug("Отправляем запрос к API Кинопоиска с параметрами: %s", params)
+    data = await get_json("/v2.2/films", params=params)
+    await _remember(data.get("films") or [])
+    return data
+
+def _parse_rating(value):
+    # Кинопоиск отдаёт рейтинг строкой, иногда "null" или ожидание в процентах ("85%")
     try:
-        data = search_films(params)
-        result = [
-            {
-                "id": f["filmId"],
-                "name": f.get("nameRu") or f.get("nameEn") or "Без названия",
-                "description": f.get("description") or "Описание отсутствует",
-                "posterUrl": f.get("posterUrlPreview") or "",
-                "year": f.get("year"),
-                "genre": f.get("genres")[0]["genre"] if f.get("genres") and len(f.get("genres")) > 0 else None,
-                "rating": f.get("rating")
-            }
-            for f in data["films"]
-            if f.get("type") == "TV_SERIES"
-        ][:5]
-        logger.info(f"Получено {len(result)} сериалов")
-        return result
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def _parse_year(value):
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def _to_film(f, genre=None):
+    return {
+        "id": f["filmId"],
+        "name": f.get("nameRu") or f.get("nameEn") or "Без названия",
+        "description": f.get("description") or "Описание отсутствует",
+        "posterUrl": public_poster_url(f["filmId"], f.get("posterUrlPreview")),
+        "year": _parse_year(f.get("year")),
+        "genre": genre or (f.get("genres")[0]["genre"] if f.get("genres") and len(f.get("genres")) > 0 else None),
+        "rating": _parse_rating(f.get("rating"))
+    }
+
+def _to_catalog(f):
+    return {
+        "id": f["filmId"],
+        "name_ru": f.get("nameRu"),
+        "name_en": f.get("nameEn"),
+        "description": f.get("description"),
+        "poster_url": f.get("posterUrlPreview"),
+        "year": _parse_year(f.get("year")),
+        "genres": [g["genre"] for g in f.get("genres") or [] if g.get("genre")],
+        "rating": _parse_rating(f.get("rating")),
+        "type": f.get("type")
+    }
+
+async def _remember(films):
+    # Write-through: всё, что пришло от апстрима, попадает в локальный каталог
+    try:
+        await run_db(save_films, [_to_catalog(f) for f in films if f.get("filmId")])
     except Exception as e:
-        logger.error(f"Ошибка в get_random_series: {e}")
-        raise
+        logger.error("Не удалось сохранить фильмы в каталог: %s", e)
 
-def get_random_movie():
-    logger.info("Запрос: получить 5 случайных фильмов")
-    params = [
+# Базовые фильтры для случайной выдачи: (type, isSerial, yearFrom)
+RANDOM_KINDS = {
+    "series": ("TV_SERIES", True, 1950),
+    "movie": ("FILM", False, 1900),
+}
+
+def _random_params(kind: str, page: int):
+    film_type, is_serial, year_from = RANDOM_KINDS[kind]
+    return [
         ("field", "type"),
-        ("value", "FILM"),
+        ("value", film_type),
         ("ratingFrom", 0),
         ("ratingTo", 10),
-        ("yearFrom", 1900),
+        ("yearFrom", year_from),
         ("yearTo", 2026),
-        ("isSerial", False),
-        ("page", 1)
+        ("isSerial", is_serial),
+        ("page", page)
+    ]
+
+@cached("fetch_random_page", ttl=CACHE_TTL_RANDOM_PAGE)
+async def fetch_random_page(kind: str, page: int):
+    # Страница случайной выдачи для пополнения пулов: пары (фильм, все жанры)
+    logger.info("Загрузка страницы %s для пула '%s'", page, kind)
+    film_type = RANDOM_KINDS[kind][0]
+    data = await search_films(_random_params(kind, page))
+    return [
+        (_to_film(f), [g["genre"] for g in f.get("genres") or [] if g.get("genre")])
+        for f in data["films"]
+        if f.get("type") == film_type
     ]
-    try:
-        data = search_films(params)
-        result = [
-            {
-                "id": f["filmId"],
-                "name": f.get("nameRu") or f.get("nameEn") or "Без названия",
-                "description": f.get("description") or "Описание отсутствует",
-                "posterUrl": f.get("posterUrlPreview") or "",
-                "year": f.get("year"),
-                "genre": f.get("genres")[0]["genre"] if f.get("genres") and len(f.get("genres")) > 0 else None,
-                "rating": f.get("rating")
-            }
-            for f in data["films"]
-            if f.get("type") == "FILM"
-        ][:5]
-        logger.info(f"Получено {len(result)} фильмов")
-        return result
-    except Exception as e:
-        logger.error(f"Ошибка в get_random_movie: {e}")
-        raise
 
-def search_by_genre_and_year(genre: str, year: int):
-    logger.info(f"Поиск по жанру '{genre}' и году '{year}'")
+@cached("search_by_genre_and_year", ttl=CACHE_TTL_GENRE_YEAR)
+async def search_by_genre_and_year(genre: str, year: int, page: int = 1):
+    # Ключ кэша не различает регистр и пробелы — запрос к апстриму и ответ тоже не должны:
+    # иначе написание первого клиента закэшируется для всех. Жанры Кинопоиска — в нижнем регистре
+    genre = " ".join(genre.split()).casefold()
+    logger.info("Поиск по жанру '%s' и году '%s', страница %s", genre, year, page)
     params = [
         ("field", "genres.name"),
         ("value", genre),
         ("field", "year"),
         ("value", str(year)),
-        ("page", 1)
+        ("page", page)
     ]
     try:
-        data = search_films(params)
-        result = [
-            {
-                "id": f["filmId"],
-                "name": f.get("nameRu") or f.get("nameEn") or "Без названия",
-                "description": f.get("description") or "Описание отсутствует",
-                "posterUrl": f.get("posterUrlPreview") or "",
-                "year": f.get("year"),
-                "genre": genre,
-                "rating": f.get("rating")
-            }
-            for f in data["films"]
-        ]
-        logger.info(f"Найдено {len(result)} фильмов по жанру и году")
+        data = await search_films(params)
+        result = FilmPage([_to_film(f, genre=genre) for f in data["films"]], _pages_count(data))
+        logger.info("Найдено %s фильмов по жанру и году", len(result))
         return result
     except Exception as e:
-        logger.error(f"Ошибка в search_by_genre_and_year: {e}")
+        logger.error("Ошибка в search_by_genre_and_year: %s", e)
         raise
 
-def search_by_title(title: str):
-    logger.info(f"Поиск по названию: '{title}'")
+@cached("search_by_title", ttl=CACHE_TTL_TITLE)
+async def search_by_title(title: str, page: int = 1):
+    logger.info("Поиск по названию: '%s', страница %s", title, page)
     params = {
         "field": "name.ru",
         "value": title,
-        "page": 1
+        "page": page
     }
     try:
-        data = search_films(params)
-        result = [
-            {
-                "id": f["filmId"],
-                "name": f.get("nameRu") or f.get("nameEn") or "Без названия",
-                "description": f.get("description") or "Описание отсутствует",
-                "posterUrl": f.get("posterUrlPreview") or "",
-                "year": f.get("year"),
-                "genre": f.get("genres")[0]["genre"] if f.get("genres") and len(f.get("genres")) > 0 else None,
-                "rating": f.get("rating")
-            }
-            for f in data["films"]
-        ]
-        logger.info(f"Найдено {len(result)} фильмов по названию")
+        data = await search_films(params)
+        result = FilmPage([_to_film(f) for f in data["films"]], _pages_count(data))
+        logger.info("Найдено %s фильмов по названию", len(result))
         return result
     except Exception as e:
-        logger.error(f"Ошибка в search_by_title: {e}")
+        logger.error("Ошибка в search_by_title: %s", e)
         raise
 
-def search_by_actor(actor_name: str):
-    logger.info(f"Поиск по актёру: '{actor_name}'")
-    headers = {"X-API-KEY": KINOPOISK_API_KEY}
+@cached("get_film", ttl=CACHE_TTL_FILM)
+async def get_film(film_id: int):
+    # Карточка фильма: поля как в выдаче поиска, но id — в kinopoiskId, рейтинг — в ratingKinopoisk.
+    # None — такого фильма у апстрима нет
+    logger.info("Загрузка карточки фильма %s", film_id)
     try:
-        response = requests.get(f"https://kinopoiskapiunofficial.tech/api/v1/staff?filmId=0&name={actor_name}", headers=headers)
-        logger.info(f"Ответ от API персон: статус {response.status_code}")
-        if response.status_code != 200:
-            logger.error(f"Ошибка API персон: {response.status_code}, текст: {response.text}")
-            raise Exception(f"Actor API error {response.status_code}: {response.text}")
-        
-        staff_data = response.json()
-        if not staff_data:
-            logger.warning("Персон не найден")
-            return []
-
-        person = staff_data[0]
-        person_id = person.get("staffId")
-        if not person_id:
-            logger.error("staffId отсутствует в ответе")
-            return []
-
-        film_response = requests.get(f"https://kinopoiskapiunofficial.tech/api/v1/staff/{person_id}/films", headers=headers)
-        logger.info(f"Ответ от API фильмов: статус {film_response.status_code}")
-        if film_response.status_code != 200:
-            logger.error(f"Ошибка API фильмов: {film_response.status_code}, текст: {film_response.text}")
-            raise Exception(f"Film API error {film_response.status_code}: {film_response.text}")
-
-        films = film_response.json()
-        result = [
-            {
-                "id": f["filmId"],
-                "name": f.get("nameRu") or f.get("nameEn") or "Без названия",
-                "description": f.get("description") or "Описание отсутствует",
-                "posterUrl": f.get("posterUrlPreview") or "",
-                "year": f.get("year"),
-                "genre": f.get("genres")[0]["genre"] if f.get("genres") and len(f.get("genres")) > 0 else None,
-                "rating": f.get("rating")
-            }
-            for f in films
-        ]
-        logger.info(f"Найдено {len(result)} фильмов по актёру")
-        return result
-    except Exception as e:
-        logger.error(f"Ошибка в search_by_actor: {e}")
-        raise
\ No newline at end of file
+        data = await get_json(f"/v2.2/films/{film_id}")
+    except KinopoiskError as e:
+        if e.status_code == 404:
+            return None
+        raise
+    film = {**data, "filmId": data.get("kinopoiskId") or film_id, "rating": data.get("ratingKinopoisk")}
+    await _remember([film])
+    return _to_film(film)
+
+async def search_staff(name: str):
+    logger.info("Поиск персоны: '%s'", name)
+    return await get_json("/v1/staff", params={"filmId": 0, "name": name}) or []
+
+async def get_staff_films(staff_id: int):
+    logger.info("Загрузка фильмов персоны %s", staff_id)
+    films = await get_json(f"/v1/staff/{staff_id}/films")
+    # description здесь — описание роли, а не фильма; в каталог его не пишем
+    await _remember([{**f, "description": None} for f in films])
+    return films
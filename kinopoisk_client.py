@@ -1,37 +1,99 @@
-import requests
-from typing import List, Dict, Any
-
-KINOPOISK_API_KEY = "H974FM6-0V3M4CP-HNA5Q7V-ARMKP1B"
-BASE_URL = "https://kinopoiskapiunofficial.tech/api/v2.2/films"
-
-
-def get_random_series(limit: int = 5) -> List[Dict[str, Any]]:
-    headers = {"X-API-KEY": KINOPOISK_API_KEY}
-    params = {
-        "field": "type",
-        "value": "TV_SERIES",
-        "ratingFrom": 0,
-        "ratingTo": 10,
-        "yearFrom": 1950,
-        "yearTo": 2026,
-        "isSerial": True,
-        "page": 1
-    }
-    response = requests.get(BASE_URL, headers=headers, params=params)
+import os
+import re
+import time
+import logging
+import httpx
+from metrics import upstream_requests_total, upstream_request_duration
+from upstream_guard import governor, CircuitOpenError, parse_retry_after
 
+logger = logging.getLogger(__name__)
+
+# Используем переменную окружения для API-ключа
+KINOPOISK_API_KEY = os.getenv("KINOPOISK_API_KEY", "H974FM6-0V3M4CP-HNA5Q7V-ARMKP1B")  # Временно, потом удалите
+if not KINOPOISK_API_KEY:
+    raise ValueError("Не установлен API-ключ KINOPOISK_API_KEY")
+
+# Базовый адрес API; для бенчмарков подменяется на локальную заглушку (benchmarks/stub_kinopoisk.py)
+BASE_URL = os.getenv("KINOPOISK_BASE_URL", "https://kinopoiskapiunofficial.tech/api")
+
+# Таймауты (секунды) и лимиты пула соединений
+KINOPOISK_CONNECT_TIMEOUT = float(os.getenv("KINOPOISK_CONNECT_TIMEOUT", "3"))
+KINOPOISK_READ_TIMEOUT = float(os.getenv("KINOPOISK_READ_TIMEOUT", "10"))
+KINOPOISK_POOL_TIMEOUT = float(os.getenv("KINOPOISK_POOL_TIMEOUT", "5"))
+KINOPOISK_MAX_CONNECTIONS = int(os.getenv("KINOPOISK_MAX_CONNECTIONS", "20"))
+KINOPOISK_MAX_KEEPALIVE = int(os.getenv("KINOPOISK_MAX_KEEPALIVE", "10"))
+KINOPOISK_KEEPALIVE_EXPIRY = float(os.getenv("KINOPOISK_KEEPALIVE_EXPIRY", "30"))
+
+# Один клиент на процесс: keep-alive соединения переиспользуются между запросами
+_client = None
+
+
+class KinopoiskError(Exception):
+    def __init__(self, status_code: int, text: str, retry_after: float = None):
+        super().__init__(f"API error {status_code}: {text}")
+        self.status_code = status_code
+        self.text = text
+        self.retry_after = retry_after
+
+
+# Апстрим недоступен (открыт предохранитель) — отвечаем быстро, не дожидаясь таймаутов
+UpstreamUnavailable = CircuitOpenError
+
+
+async def start_client():
+    global _client
+    if _client is not None:
+        return _client
+    logger.info("Открываем пул соединений к Кинопоиску (max=%s, keepalive=%s)", KINOPOISK_MAX_CONNECTIONS, KINOPOISK_MAX_KEEPALIVE)
+    _client = httpx.AsyncClient(
+        base_url=BASE_URL,
+        headers={"X-API-KEY": KINOPOISK_API_KEY},
+        timeout=httpx.Timeout(
+            KINOPOISK_READ_TIMEOUT,
+            connect=KINOPOISK_CONNECT_TIMEOUT,
+            pool=KINOPOISK_POOL_TIMEOUT,
+        ),
+        limits=httpx.Limits(
+            max_connections=KINOPOISK_MAX_CONNECTIONS,
+            max_keepalive_connections=KINOPOISK_MAX_KEEPALIVE,
+            keepalive_expiry=KINOPOISK_KEEPALIVE_EXPIRY,
+        ),
+    )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is None:
+        return
+    logger.info("Закрываем пул соединений к Кинопоиску")
+    await _client.aclose()
+    _client = None
+
+
+_ID_RE = re.compile(r"/\d+")
+
+
+async def get_json(path: str, params=None):
+    client = _client or await start_client()
+    endpoint = _ID_RE.sub("/{id}", path)
+
+    async def send():
+        # Каждая попытка (включая повторы) учитывается отдельно
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = await client.get(path, params=params)
+            status = str(response.status_code)
+            return response
+        finally:
+            upstream_request_duration.observe(time.perf_counter() - start, (endpoint,))
+            upstream_requests_total.inc((endpoint, status))
+
+    # Квота, ограничение параллелизма, повторы и предохранитель — в governor
+    response = await governor.call(send)
+    logger.debug("Ответ от API %s: статус %s, длина %s байт", path, response.status_code, len(response.content))
     if response.status_code != 200:
-        raise Exception(f"Ошибка API Кинопоиска: {response.status_code}")
-
-    data = response.json()
-    series_list = [
-                      {
-                          "id": film["filmId"],
-                          "name": film.get("nameRu") or film.get("nameEn") or "Без названия",
-                          "description": film.get("description") or "Описание отсутствует",
-                          "posterUrl": film.get("posterUrlPreview") or ""
-                      }
-                      for film in data["films"]
-                      if film["type"] == "TV_SERIES"
-                  ][:limit]
-
-    return series_list
\ No newline at end of file
+        logger.error("Ошибка API %s: %s, текст: %s", path, response.status_code, response.text)
+        raise KinopoiskError(response.status_code, response.text, parse_retry_after(response))
+    return response.json()
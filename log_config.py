@@ -0,0 +1,126 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# Уровень по умолчанию и уровни для отдельных модулей: "database=WARNING,kinopoisk_api=DEBUG"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "httpx=WARNING")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json | text
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Сэмплирование повторяющихся сообщений уровня ниже WARNING:
+# не больше LOG_SAMPLE_BURST записей одного шаблона за LOG_SAMPLE_WINDOW секунд
+LOG_SAMPLE_BURST = int(os.getenv("LOG_SAMPLE_BURST", "20"))
+LOG_SAMPLE_WINDOW = float(os.getenv("LOG_SAMPLE_WINDOW", "1"))
+
+_listener = None
+
+
+class SamplingFilter(logging.Filter):
+    # Ключ — логгер и шаблон сообщения (record.msg без подстановки аргументов),
+    # поэтому сообщения одного вида считаются вместе независимо от параметров запроса
+    def __init__(self, burst: int, window: float):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.burst <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            state = self._windows.get(key)
+            if state is None or now - state[0] >= self.window:
+                suppressed = state[2] if state else 0
+                self._windows[key] = [now, 1, 0]
+            elif state[1] < self.burst:
+                state[1] += 1
+                suppressed = 0
+            else:
+                state[2] += 1
+                return False
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class _LazyQueueHandler(QueueHandler):
+    # Стандартный prepare() форматирует запись в вызывающем потоке;
+    # здесь запись уходит в очередь как есть, форматирует её поток-писатель
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Писатель не успевает — теряем запись, но не блокируем обработку запросов
+            pass
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))}.{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _parse_levels(spec: str) -> dict:
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging():
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = _LazyQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(LOG_SAMPLE_BURST, LOG_SAMPLE_WINDOW))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    for name, level in _parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        # Дописываем всё, что осталось в очереди
+        _listener.stop()
+        _listener = None
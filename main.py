@@ -1,108 +1,485 @@
-from fastapi import FastAPI, HTTPException, Query
+from log_config import setup_logging
+
+# Логирование настраивается до импорта остальных модулей, чтобы их записи шли через общую очередь
+setup_logging()
+
+from contextlib import asynccontextmanager
+import uuid
+import asyncio
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse, StreamingResponse, FileResponse, Response
 from pydantic import BaseModel
 from typing import List, Optional
-from models import Film, UserCollection
-from database import init_db, add_film_to_collection, get_user_collections
+from models import (
+    Film,
+    UserCollection,
+    PairSessionCreate,
+    SessionGenres,
+    SessionVote,
+    VoteResult,
+    FilmIdsRequest,
+    BatchItemStatus,
+    SessionVotesBatch,
+    BatchVoteStatus,
+    FacetCounts,
+    FilmFilterResult,
+)
+from database import (
+    init_db,
+    close_db,
+    run_db,
+    add_film_to_collection,
+    add_films_to_collection,
+    get_collection_membership,
+    get_user_collections,
+    get_films_by_ids,
+    create_pair_session,
+    save_genres_for_user_in_session,
+    get_session_matches,
+    SessionNotFound,
+    SessionExists,
+)
 import logging
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-from kinopoisk_api import (
-    get_random_series,
-    get_random_movie,
-    search_by_genre_and_year,
-    search_by_title,
-    search_by_actor
+from kinopoisk_client import start_client, close_client, KinopoiskError, UpstreamUnavailable
+from upstream_guard import governor
+import metrics
+from cache import film_cache
+from random_pool import start_pools, stop_pools, random_films, pool_stats
+import matching
+from matching import match_index, event_relay
+from retention import session_compactor
+from workers import WORKER_COUNT, SHARED_STATE
+from kinopoisk_api import search_by_genre_and_year
+from catalog_search import find_by_title, find_by_actor, filter_films, facet_counts, collection_films, FACET_PAGE_SIZE
+from fast_json import json_response, entry_response, etag_matches
+from posters import poster_store, close_posters, PosterNotFound, POSTER_SIZES, POSTER_MAX_AGE, ORIGINAL
+from pagination import (
+    SEARCH_STREAM_MAX_PAGES,
+    NDJSON_MEDIA_TYPE,
+    InvalidCursor,
+    PageStream,
+    decode_cursor_state,
+    next_cursor,
 )
 
-app = FastAPI(title="Full Film API Server")
-init_db()
+def _http_error(e: Exception) -> HTTPException:
+    if isinstance(e, SessionNotFound):
+        # Сессию удалила очистка истёкших — забываем и её состояние в памяти
+        match_index.forget(e.session_id)
+        return HTTPException(status_code=404, detail="Сессия не найдена")
+    if isinstance(e, SessionExists):
+        # session_id задал клиент и он уже занят — текст ошибки базы наружу не отдаём
+        return HTTPException(status_code=409, detail="Сессия с таким идентификатором уже существует")
+    if isinstance(e, UpstreamUnavailable):
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(e.retry_after) + 1)})
+    if isinstance(e, KinopoiskError) and e.status_code == 429:
+        # Сколько ждать, знает только апстрим — передаём его Retry-After клиенту
+        headers = {"Retry-After": str(int(e.retry_after) + 1)} if e.retry_after is not None else None
+        return HTTPException(status_code=503, detail="Превышена квота API Кинопоиска", headers=headers)
+    return HTTPException(status_code=500, detail=str(e))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Схема создаётся под файловой блокировкой: воркеры стартуют одновременно, миграции выполнит один
+    init_db()
+    # Общий пул соединений к Кинопоиску живёт столько же, сколько приложение
+    await start_client()
+    await start_pools()
+    if SHARED_STATE:
+        await event_relay.start()
+    session_compactor.start()
+    try:
+        yield
+    finally:
+        await session_compactor.stop()
+        await event_relay.stop()
+        await stop_pools()
+        await close_client()
+        await close_posters()
+        close_db()
+
+app = FastAPI(title="Full Film API Server", lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+
+@metrics.register_collector
+def _service_metrics():
+    cache_stats = film_cache.snapshot()
+    upstream = governor.snapshot()
+    return [
+        ("film_cache_events_total", "counter", "События кэша ответов апстрима",
+         [({"event": k}, cache_stats[k]) for k in film_cache.stats]),
+        ("film_cache_entries", "gauge", "Записей в кэше ответов", [({}, cache_stats["size"])]),
+        ("film_cache_hit_ratio", "gauge", "Доля запросов, обслуженных кэшем", [({}, cache_stats["hit_ratio"])]),
+        ("upstream_governor_events_total", "counter", "События ограничителя запросов к апстриму",
+         [({"event": k}, upstream[k]) for k in governor.stats]),
+        ("upstream_in_flight", "gauge", "Запросы к апстриму в процессе", [({}, upstream["in_flight"])]),
+        ("upstream_tokens", "gauge", "Доступные токены квоты", [({}, upstream["tokens"])]),
+        ("upstream_breaker_open", "gauge", "Предохранитель апстрима открыт (1) или нет (0)",
+         [({}, 0 if upstream["breaker_state"] == "closed" else 1)]),
+        ("random_pool_size", "gauge", "Фильмов в пулах случайной выдачи",
+         [({"kind": kind}, size) for kind, size in pool_stats().items()]),
+    ]
+
+@app.get("/metrics", include_in_schema=False)
+async def api_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.get("/")
 async def root():
     logger.info("Запрос к корню сервера")
     return {"message": "Film API Server", "status": "running"}
 
+@app.get("/api/cache/stats")
+async def api_cache_stats():
+    return {**film_cache.snapshot(), "random_pools": pool_stats()}
+
+@app.get("/api/upstream/stats")
+async def api_upstream_stats():
+    return governor.snapshot()
+
 @app.get("/api/random-series", response_model=List[Film])
-async def api_get_random_series():
+async def api_get_random_series(
+    request: Request,
+    count: int = Query(5, ge=1, le=50),
+    genre: Optional[str] = None,
+    year: Optional[int] = None
+):
     logger.info("Получен запрос на получение случайных сериалов")
     try:
-        result = get_random_series()
-        logger.info(f"Отправлено {len(result)} сериалов")
-        return result
+        result = await random_films("series", count, genre, year)
+        logger.info("Отправлено %s сериалов", len(result))
+        # Выдача случайна — ETag бесполезен
+        return json_response(request, result, etag=False)
     except Exception as e:
-        logger.error(f"Ошибка в api_get_random_series: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.error("Ошибка в api_get_random_series: %s", e)
+        raise _http_error(e)
 
 @app.get("/api/random-movie", response_model=List[Film])
-async def api_get_random_movie():
+async def api_get_random_movie(
+    request: Request,
+    count: int = Query(5, ge=1, le=50),
+    genre: Optional[str] = None,
+    year: Optional[int] = None
+):
     logger.info("Получен запрос на получение случайных фильмов")
     try:
-        result = get_random_movie()
-        logger.info(f"Отправлено {len(result)} фильмов")
-        return result
+        result = await random_films("movie", count, genre, year)
+        logger.info("Отправлено %s фильмов", len(result))
+        return json_response(request, result, etag=False)
     except Exception as e:
-        logger.error(f"Ошибка в api_get_random_movie: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.error("Ошибка в api_get_random_movie: %s", e)
+        raise _http_error(e)
+
+@app.get("/posters/{film_id}")
+async def api_poster(request: Request, film_id: int, size: str = "medium"):
+    if size != ORIGINAL and size not in POSTER_SIZES:
+        raise HTTPException(status_code=400, detail=f"Неизвестный размер постера: {size}")
+    try:
+        path, digest, media_type = await poster_store.get(film_id, size)
+    except PosterNotFound:
+        raise HTTPException(status_code=404, detail="Постер не найден")
+    except Exception as e:
+        logger.error("Ошибка в api_poster: %s", e)
+        raise _http_error(e)
+    # Содержимое адресуется хешем — он же и есть ETag
+    headers = {"ETag": f'"{digest}"', "Cache-Control": f"public, max-age={POSTER_MAX_AGE}"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    # FileResponse отдаёт файл с диска потоком (sendfile, если сервер поддерживает), не читая его в память целиком
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+def _page_or_400(cursor: Optional[str]) -> int:
+    return _cursor_or_400(cursor)[0]
+
+def _cursor_or_400(cursor: Optional[str]):
+    try:
+        return decode_cursor_state(cursor)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _with_next_cursor(response, cursor: Optional[str]):
+    if cursor is not None:
+        response.headers["X-Next-Cursor"] = cursor
+    return response
+
+async def _stream_pages(fetch_page, first: int, count: int) -> StreamingResponse:
+    # Ответ уходит, как только пришла первая страница; остальные дописываются в поток по мере загрузки
+    stream = await PageStream(fetch_page, first, count).start()
+    response = StreamingResponse(stream.ndjson(), media_type=NDJSON_MEDIA_TYPE)
+    return _with_next_cursor(response, stream.next_cursor)
 
 @app.get("/api/search-by-genre-year", response_model=List[Film])
-async def api_search_by_genre_year(genre: str, year: int):
-    logger.info(f"Получен запрос на поиск по жанру '{genre}' и году '{year}'")
+async def api_search_by_genre_year(
+    request: Request,
+    genre: str,
+    year: int,
+    cursor: Optional[str] = None,
+    pages: int = Query(1, ge=1, le=SEARCH_STREAM_MAX_PAGES)
+):
+    page = _page_or_400(cursor)
+    logger.info("Получен запрос на поиск по жанру '%s' и году '%s', страница %s", genre, year, page)
     try:
-        result = search_by_genre_and_year(genre, year)
-        logger.info(f"Отправлено {len(result)} фильмов по жанру и году")
-        return result
+        if pages > 1:
+            return await _stream_pages(lambda p: search_by_genre_and_year(genre, year, p), page, pages)
+        entry = await search_by_genre_and_year.entry(genre, year, page)
+        logger.info("Отправлено %s фильмов по жанру и году", len(entry.value))
+        return _with_next_cursor(entry_response(request, entry), next_cursor(page, entry.value.pages))
     except Exception as e:
-        logger.error(f"Ошибка в api_search_by_genre_year: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.error("Ошибка в api_search_by_genre_year: %s", e)
+        raise _http_error(e)
 
 @app.get("/api/search-by-title", response_model=List[Film])
-async def api_search_by_title(title: str = Query(..., min_length=1)):
-    logger.info(f"Получен запрос на поиск по названию: '{title}'")
+async def api_search_by_title(
+    request: Request,
+    title: str = Query(..., min_length=1),
+    cursor: Optional[str] = None,
+    pages: int = Query(1, ge=1, le=SEARCH_STREAM_MAX_PAGES)
+):
+    page, state = _cursor_or_400(cursor)
+    skip = state.get("skip", [])
+    logger.info("Получен запрос на поиск по названию: '%s', страница %s", title, page)
     try:
-        result = search_by_title(title)
-        logger.info(f"Отправлено {len(result)} фильмов по названию")
-        return result
+        if pages > 1:
+            # В потоке первая страница всегда включает страницу 1 апстрима: следующие идут за ней подряд
+            return await _stream_pages(lambda p: find_by_title(title, p, skip, local_first=False), page, pages)
+        result = await find_by_title(title, page, skip)
+        logger.info("Отправлено %s фильмов по названию", len(result))
+        last_page = page if result.last_page is None else result.last_page
+        return _with_next_cursor(json_response(request, result), next_cursor(last_page, result.pages, **result.cursor_state))
     except Exception as e:
-        logger.error(f"Ошибка в api_search_by_title: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.error("Ошибка в api_search_by_title: %s", e)
+        raise _http_error(e)
 
 @app.get("/api/search-by-actor", response_model=List[Film])
-async def api_search_by_actor(actor: str = Query(..., min_length=1)):
-    logger.info(f"Получен запрос на поиск по актёру: '{actor}'")
+async def api_search_by_actor(request: Request, actor: str = Query(..., min_length=1)):
+    logger.info("Получен запрос на поиск по актёру: '%s'", actor)
+    try:
+        result = await find_by_actor(actor)
+        logger.info("Отправлено %s фильмов по актёру", len(result))
+        return json_response(request, result)
+    except Exception as e:
+        logger.error("Ошибка в api_search_by_actor: %s", e)
+        raise _http_error(e)
+
+@app.get("/api/films/filter", response_model=FilmFilterResult)
+async def api_filter_films(
+    request: Request,
+    genre: List[str] = Query([]),
+    genre_mode: str = Query("all", pattern="^(all|any)$"),
+    year_from: Optional[int] = None,
+    year_to: Optional[int] = None,
+    min_rating: Optional[float] = Query(None, ge=0, le=10),
+    cursor: Optional[str] = None,
+    facets: bool = True
+):
+    page = _page_or_400(cursor)
+    logger.info("Получен запрос на фильтрацию каталога: жанры %s (%s), годы %s-%s, рейтинг от %s, страница %s",
+                genre, genre_mode, year_from, year_to, min_rating, page)
     try:
-        result = search_by_actor(actor)
-        logger.info(f"Отправлено {len(result)} фильмов по актёру")
-        return result
+        result = await filter_films(genre, genre_mode, year_from, year_to, min_rating, page, facets)
+        logger.info("Отправлено %s из %s фильмов по фильтру", len(result["films"]), result["total"])
+        pages = max(1, -(-result["total"] // FACET_PAGE_SIZE))
+        return _with_next_cursor(json_response(request, result), next_cursor(page, pages))
     except Exception as e:
-        logger.error(f"Ошибка в api_search_by_actor: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.error("Ошибка в api_filter_films: %s", e)
+        raise _http_error(e)
+
+@app.get("/api/films/facets", response_model=FacetCounts)
+async def api_film_facets(
+    request: Request,
+    genre: List[str] = Query([]),
+    genre_mode: str = Query("all", pattern="^(all|any)$"),
+    year_from: Optional[int] = None,
+    year_to: Optional[int] = None,
+    min_rating: Optional[float] = Query(None, ge=0, le=10)
+):
+    logger.info("Получен запрос на фасеты каталога")
+    try:
+        return json_response(request, await facet_counts(genre, genre_mode, year_from, year_to, min_rating))
+    except Exception as e:
+        logger.error("Ошибка в api_film_facets: %s", e)
+        raise _http_error(e)
 
 @app.post("/api/add-to-collection")
 async def api_add_to_collection(user_id: str, film_id: int):
-    logger.info(f"Получен запрос на добавление фильма {film_id} пользователю {user_id}")
+    logger.info("Получен запрос на добавление фильма %s пользователю %s", film_id, user_id)
     try:
-        add_film_to_collection(user_id, film_id)
-        logger.info(f"Фильм {film_id} успешно добавлен пользователю {user_id}")
+        await run_db(add_film_to_collection, user_id, film_id)
+        logger.info("Фильм %s успешно добавлен пользователю %s", film_id, user_id)
         return {"message": "Фильм добавлен в подборку"}
     except Exception as e:
-        logger.error(f"Ошибка в api_add_to_collection: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.error("Ошибка в api_add_to_collection: %s", e)
+        raise _http_error(e)
+
+@app.post("/api/user-collections/{user_id}/batch", response_model=List[BatchItemStatus])
+async def api_add_to_collection_batch(user_id: str, body: FilmIdsRequest):
+    logger.info("Получен запрос на пакетное добавление %s фильмов пользователю %s", len(body.film_ids), user_id)
+    try:
+        statuses = await run_db(add_films_to_collection, user_id, body.film_ids)
+        return [{"film_id": film_id, "status": status} for film_id, status in statuses.items()]
+    except Exception as e:
+        logger.error("Ошибка в api_add_to_collection_batch: %s", e)
+        raise _http_error(e)
+
+@app.post("/api/user-collections/{user_id}/contains", response_model=List[int])
+async def api_collection_contains(user_id: str, body: FilmIdsRequest):
+    logger.info("Получен запрос на проверку %s фильмов в подборке пользователя %s", len(body.film_ids), user_id)
+    try:
+        return await run_db(get_collection_membership, user_id, body.film_ids)
+    except Exception as e:
+        logger.error("Ошибка в api_collection_contains: %s", e)
+        raise _http_error(e)
 
 @app.get("/api/user-collections/{user_id}", response_model=List[int])
-async def api_get_user_collections_endpoint(user_id: str):
-    logger.info(f"Получен запрос на получение подборки пользователя {user_id}")
+async def api_get_user_collections_endpoint(request: Request, user_id: str):
+    logger.info("Получен запрос на получение подборки пользователя %s", user_id)
+    try:
+        result = await run_db(get_user_collections, user_id)
+        logger.info("Отправлено %s фильмов из подборки пользователя %s", len(result), user_id)
+        return json_response(request, result)
+    except Exception as e:
+        logger.error("Ошибка в api_get_user_collections_endpoint: %s", e)
+        raise _http_error(e)
+
+@app.get("/api/user-collections/{user_id}/films", response_model=List[Film])
+async def api_get_user_collection_films(request: Request, user_id: str):
+    logger.info("Получен запрос на получение фильмов подборки пользователя %s", user_id)
+    try:
+        result, missing = await collection_films(user_id)
+        logger.info("Отправлено %s фильмов из подборки пользователя %s", len(result), user_id)
+        response = json_response(request, result)
+        if missing:
+            # Фильмы, которых нет ни в каталоге, ни у апстрима: клиент знает, что список неполный
+            response.headers["X-Missing-Film-Ids"] = ",".join(map(str, missing))
+        return response
+    except Exception as e:
+        logger.error("Ошибка в api_get_user_collection_films: %s", e)
+        raise _http_error(e)
+
+async def _session_or_404(session_id: str, user_id: Optional[str] = None):
+    state = await match_index.get(session_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Сессия не найдена")
+    if user_id is not None and user_id not in state.users:
+        raise HTTPException(status_code=403, detail="Пользователь не участвует в сессии")
+    return state
+
+@app.post("/api/sessions")
+async def api_create_session(body: PairSessionCreate):
+    session_id = body.session_id or uuid.uuid4().hex
+    logger.info("Получен запрос на создание сессии %s", session_id)
+    try:
+        await run_db(create_pair_session, session_id, body.user_a, body.user_b)
+        match_index.forget(session_id)
+        return {"session_id": session_id}
+    except Exception as e:
+        logger.error("Ошибка в api_create_session: %s", e)
+        raise _http_error(e)
+
+@app.post("/api/sessions/{session_id}/genres")
+async def api_save_session_genres(session_id: str, body: SessionGenres):
+    await _session_or_404(session_id, body.user_id)
+    logger.info("Получен запрос на сохранение жанров пользователя %s в сессии %s", body.user_id, session_id)
+    try:
+        await run_db(save_genres_for_user_in_session, session_id, body.user_id, body.genres)
+        return {"message": "Жанры сохранены"}
+    except Exception as e:
+        logger.error("Ошибка в api_save_session_genres: %s", e)
+        raise _http_error(e)
+
+@app.post("/api/sessions/{session_id}/next-film", response_model=Film)
+async def api_session_next_film(session_id: str):
+    state = await _session_or_404(session_id)
+    logger.info("Получен запрос на следующий фильм в сессии %s", session_id)
+    try:
+        film = await matching.advance(state)
+    except Exception as e:
+        logger.error("Ошибка в api_session_next_film: %s", e)
+        raise _http_error(e)
+    if film is None:
+        raise HTTPException(status_code=404, detail="Нет фильмов для показа")
+    return film
+
+@app.post("/api/sessions/{session_id}/votes", response_model=VoteResult)
+async def api_session_vote(session_id: str, body: SessionVote):
+    state = await _session_or_404(session_id, body.user_id)
+    logger.info("Получен голос пользователя %s за фильм %s в сессии %s", body.user_id, body.film_id, session_id)
+    try:
+        matched, next_film = await matching.vote(state, body.user_id, body.film_id, body.vote)
+        return {"match": matched, "next_film": next_film}
+    except Exception as e:
+        logger.error("Ошибка в api_session_vote: %s", e)
+        raise _http_error(e)
+
+@app.post("/api/sessions/{session_id}/votes/batch", response_model=List[BatchVoteStatus])
+async def api_session_vote_batch(session_id: str, body: SessionVotesBatch):
+    state = await _session_or_404(session_id)
+    logger.info("Получен пакет из %s голосов в сессии %s", len(body.votes), session_id)
     try:
-        result = get_user_collections(user_id)
-        logger.info(f"Отправлено {len(result)} фильмов из подборки пользователя {user_id}")
-        return result
+        results, _ = await matching.vote_many(state, [(v.user_id, v.film_id, v.vote) for v in body.votes])
+        return results
     except Exception as e:
-        logger.error(f"Ошибка в api_get_user_collections_endpoint: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.error("Ошибка в api_session_vote_batch: %s", e)
+        raise _http_error(e)
+
+@app.get("/api/sessions/{session_id}/matches", response_model=List[Film])
+async def api_session_matches(request: Request, session_id: str):
+    state = await _session_or_404(session_id)
+    logger.info("Получен запрос на совпадения в сессии %s", session_id)
+    try:
+        # При нескольких воркерах копия состояния может отставать на такт ленты событий — читаем базу
+        matches = await run_db(get_session_matches, session_id) if SHARED_STATE else list(state.matches)
+        return json_response(request, await run_db(get_films_by_ids, matches))
+    except Exception as e:
+        logger.error("Ошибка в api_session_matches: %s", e)
+        raise _http_error(e)
+
+@app.websocket("/api/sessions/{session_id}/ws")
+async def ws_session_events(websocket: WebSocket, session_id: str):
+    state = await match_index.get(session_id)
+    if state is None:
+        await websocket.close(code=4404)
+        return
+    await websocket.accept()
+    events = state.subscribe()
+    logger.info("Подписчик подключён к сессии %s", session_id)
+
+    async def receive_until_disconnect():
+        # Входящие сообщения не нужны, читаем только чтобы заметить отключение клиента
+        while True:
+            await websocket.receive_text()
+
+    receiver = asyncio.create_task(receive_until_disconnect())
+    try:
+        while True:
+            getter = asyncio.create_task(events.get())
+            done, _ = await asyncio.wait({getter, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver in done:
+                getter.cancel()
+                break
+            await websocket.send_json(getter.result())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        state.unsubscribe(events)
+        logger.info("Подписчик отключён от сессии %s", session_id)
 
 # Исправленное условие
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Миграции — один раз в родительском процессе, до запуска воркеров
+    init_db()
+    # log_config=None: логгеры uvicorn пишут через корневой логгер и общую очередь.
+    # Несколько воркеров uvicorn запускает только по строке импорта приложения.
+    uvicorn.run(
+        app if WORKER_COUNT == 1 else "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=WORKER_COUNT,
+        log_config=None,
+    )
\ No newline at end of file
@@ -0,0 +1,311 @@
+import os
+import time
+import asyncio
+import logging
+import orjson
+from collections import OrderedDict
+from database import (
+    run_db,
+    get_users_in_session,
+    record_votes,
+    save_votes_in_session,
+    save_session_matches,
+    get_votes_in_session,
+    get_session_matches,
+    add_shown_film_to_session,
+    get_genres_for_users_in_session,
+    get_shown_films_in_session,
+    get_films_by_ids,
+    save_session_event,
+    get_last_session_event_id,
+    get_session_events_after,
+    delete_session_events_before,
+)
+from random_pool import random_films
+from ranking import get_candidates
+from workers import SHARED_STATE
+
+logger = logging.getLogger(__name__)
+
+# Сколько сессий держим в памяти; сессии с подписчиками не вытесняются
+MATCH_INDEX_MAX_SESSIONS = int(os.getenv("MATCH_INDEX_MAX_SESSIONS", "10000"))
+SESSION_EVENT_QUEUE_SIZE = int(os.getenv("SESSION_EVENT_QUEUE_SIZE", "100"))
+# Несколько воркеров: как часто читаем общую ленту событий и сколько секунд её храним
+SESSION_EVENT_POLL_SECONDS = float(os.getenv("SESSION_EVENT_POLL_SECONDS", "0.25"))
+SESSION_EVENT_RETENTION = int(os.getenv("SESSION_EVENT_RETENTION", "3600"))
+SESSION_EVENT_BATCH = 500
+# Когда каталог под жанры исчерпан: сколько раз и по сколько фильмов берём из пула случайных,
+# ища ещё не показанный в сессии
+SESSION_RANDOM_ATTEMPTS = int(os.getenv("SESSION_RANDOM_ATTEMPTS", "3"))
+SESSION_RANDOM_BATCH = int(os.getenv("SESSION_RANDOM_BATCH", "5"))
+
+
+class SessionState:
+    def __init__(self, session_id: str, users: tuple):
+        self.session_id = session_id
+        self.users = users
+        # Только в режиме одного воркера: все голоса сессии в памяти, совпадение — O(1) на голос.
+        # При нескольких воркерах голоса приходят и в другие процессы — там решает база (record_votes)
+        self.likes = {}  # film_id -> пользователи, сказавшие "да"
+        self.voted = {}  # film_id -> пользователи, проголосовавшие хоть как-то
+        self.matches = []
+        self._matched = set()
+        self.current_film = None
+        self.subscribers = set()
+
+    def add_match(self, film_id: int):
+        if film_id not in self._matched:
+            self._matched.add(film_id)
+            self.matches.append(film_id)
+
+    def apply_votes(self, votes: list) -> dict:
+        # -> то же, что record_votes: {film_id: {"matched": ..., "completed": ...}}
+        before = {film_id: len(self.voted.get(film_id, ())) for _, film_id, _ in votes}
+        for user_id, film_id, vote in votes:
+            self.voted.setdefault(film_id, set()).add(user_id)
+            liked = self.likes.setdefault(film_id, set())
+            if vote:
+                liked.add(user_id)
+            else:
+                liked.discard(user_id)
+        result = {}
+        for film_id, voted_before in before.items():
+            matched = len(self.likes[film_id]) == len(self.users) and film_id not in self._matched
+            if matched:
+                # Отмечаем сразу: параллельный голос не должен объявить это совпадение ещё раз
+                self.add_match(film_id)
+            result[film_id] = {
+                "matched": matched,
+                "completed": voted_before < len(self.users) <= len(self.voted[film_id]),
+            }
+        return result
+
+    async def publish(self, event: dict):
+        if SHARED_STATE:
+            # Подписчики могут быть подключены к другому воркеру — событие идёт через базу,
+            # EventRelay каждого воркера (и этого тоже) раздаст его своим подписчикам
+            await run_db(save_session_event, self.session_id, orjson.dumps(event).decode())
+        else:
+            self.deliver(event)
+
+    def deliver(self, event: dict):
+        # Копия состояния обновляется и по событиям, пришедшим от других воркеров
+        if event["type"] == "match":
+            self.add_match(event["film_id"])
+        elif event["type"] == "next_film":
+            self.current_film = event["film"]["id"]
+        for q in list(self.subscribers):
+            try:
+                q.put_nowait(event)
+            except asyncio.QueueFull:
+                # Медленный клиент: выбрасываем накопленное и просим перечитать состояние сессии
+                logger.warning("Очередь событий сессии %s переполнена, отправляем resync", self.session_id)
+                while not q.empty():
+                    q.get_nowait()
+                q.put_nowait({"type": "resync"})
+
+    def subscribe(self) -> asyncio.Queue:
+        q = asyncio.Queue(maxsize=SESSION_EVENT_QUEUE_SIZE)
+        self.subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q: asyncio.Queue):
+        self.subscribers.discard(q)
+
+
+class MatchIndex:
+    def __init__(self, max_sessions: int = MATCH_INDEX_MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._loading = {}
+
+    async def get(self, session_id: str):
+        state = self._sessions.get(session_id)
+        if state is not None:
+            self._sessions.move_to_end(session_id)
+            return state
+        # Участников и совпадения читаем из базы один раз на сессию, параллельные запросы ждут одну загрузку
+        task = self._loading.get(session_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load(session_id))
+            self._loading[session_id] = task
+        return await asyncio.shield(task)
+
+    def peek(self, session_id: str):
+        return self._sessions.get(session_id)
+
+    async def _load(self, session_id: str):
+        try:
+            user_a, user_b = await run_db(get_users_in_session, session_id)
+            if user_a is None:
+                return None
+            state = SessionState(session_id, (user_a, user_b))
+            for film_id in await run_db(get_session_matches, session_id):
+                state.add_match(film_id)
+            if not SHARED_STATE:
+                for user_id, user_votes in (await run_db(get_votes_in_session, session_id)).items():
+                    state.apply_votes([(user_id, film_id, vote) for film_id, vote in user_votes.items()])
+            self._sessions[session_id] = state
+            self._evict()
+            logger.info("Сессия %s загружена в индекс совпадений: %s совпадений", session_id, len(state.matches))
+            return state
+        finally:
+            self._loading.pop(session_id, None)
+
+    def _evict(self):
+        if len(self._sessions) <= self.max_sessions:
+            return
+        for session_id in list(self._sessions):
+            if len(self._sessions) <= self.max_sessions:
+                break
+            if not self._sessions[session_id].subscribers:
+                del self._sessions[session_id]
+
+    def forget(self, session_id: str):
+        self._sessions.pop(session_id, None)
+
+
+match_index = MatchIndex()
+
+
+class EventRelay:
+    # Только при SHARED_STATE: читает новые записи session_events и раздаёт их сессиям этого воркера
+    def __init__(self, index: MatchIndex):
+        self.index = index
+        self.last_id = 0
+        self._task = None
+
+    async def start(self):
+        self.last_id = await run_db(get_last_session_event_id)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _poll(self) -> int:
+        rows = await run_db(get_session_events_after, self.last_id, SESSION_EVENT_BATCH)
+        for event_id, session_id, payload in rows:
+            self.last_id = event_id
+            state = self.index.peek(session_id)
+            if state is not None:
+                event = orjson.loads(payload)
+                state.deliver(event)
+                if event["type"] == "expired":
+                    self.index.forget(session_id)
+        return len(rows)
+
+    async def _run(self):
+        pruned_at = time.monotonic()
+        while True:
+            received = 0
+            try:
+                received = await self._poll()
+                if time.monotonic() - pruned_at > SESSION_EVENT_RETENTION / 10:
+                    pruned_at = time.monotonic()
+                    await run_db(delete_session_events_before, int(time.time()) - SESSION_EVENT_RETENTION)
+            except Exception as e:
+                logger.error("Ошибка чтения ленты событий сессий: %s", e)
+            if received < SESSION_EVENT_BATCH:
+                await asyncio.sleep(SESSION_EVENT_POLL_SECONDS)
+
+
+event_relay = EventRelay(match_index)
+
+
+async def pick_next_film(state: SessionState, shown):
+    user_a, user_b = state.users
+    genres = await run_db(get_genres_for_users_in_session, state.session_id)
+    candidates = await get_candidates()
+    for film_id in candidates.rank(genres.get(user_a, []), genres.get(user_b, []), shown, k=1):
+        films = await run_db(get_films_by_ids, [film_id])
+        if films:
+            return films[0]
+    return None
+
+
+async def pick_random_film(shown):
+    shown = set(shown.tolist())
+    for _ in range(SESSION_RANDOM_ATTEMPTS):
+        films = await random_films("movie", SESSION_RANDOM_BATCH)
+        for film in films:
+            if film["id"] not in shown:
+                return film
+        if not films:
+            break
+    return None
+
+
+async def advance(state: SessionState):
+    # Выбираем следующий фильм, помечаем его показанным и рассылаем обоим участникам
+    shown = await run_db(get_shown_films_in_session, state.session_id)
+    film = await pick_next_film(state, shown)
+    if film is None:
+        # Каталог под жанры исчерпан — берём из пула случайных фильмов
+        film = await pick_random_film(shown)
+    if film is None:
+        logger.warning("Нет фильмов для показа в сессии %s", state.session_id)
+        return None
+    await run_db(add_shown_film_to_session, state.session_id, film["id"])
+    state.current_film = film["id"]
+    await state.publish({"type": "next_film", "film": film})
+    return film
+
+
+async def _apply_outcomes(state: SessionState, outcomes: dict) -> set:
+    # Совпадение объявляет тот запрос, чья транзакция его создала, — ровно один раз на все воркеры
+    matched = set()
+    for film_id, outcome in outcomes.items():
+        if outcome["matched"]:
+            matched.add(film_id)
+            state.add_match(film_id)
+            logger.info("Совпадение в сессии %s: фильм %s", state.session_id, film_id)
+            await state.publish({"type": "match", "film_id": film_id})
+    return matched
+
+
+async def _record(state: SessionState, votes: list) -> dict:
+    if SHARED_STATE:
+        return await run_db(record_votes, state.session_id, state.users, votes)
+    # Один воркер: голос пишется в базу, совпадение решает индекс в памяти
+    await run_db(save_votes_in_session, state.session_id, votes)
+    outcomes = state.apply_votes(votes)
+    matched = [film_id for film_id, outcome in outcomes.items() if outcome["matched"]]
+    if matched:
+        await run_db(save_session_matches, state.session_id, matched)
+    return outcomes
+
+
+async def vote(state: SessionState, user_id: str, film_id: int, value: bool):
+    outcomes = await _record(state, [(user_id, film_id, value)])
+    matched = film_id in await _apply_outcomes(state, outcomes)
+    next_film = None
+    if film_id == state.current_film and outcomes[film_id]["completed"]:
+        next_film = await advance(state)
+    return matched, next_film
+
+
+async def vote_many(state: SessionState, votes: list):
+    # votes — список (user_id, film_id, vote); чужие голоса отбрасываются, остальные пишутся одной транзакцией
+    accepted = [v for v in votes if v[0] in state.users]
+    outcomes = await _record(state, accepted)
+    matched = await _apply_outcomes(state, outcomes)
+    results = []
+    for user_id, film_id, value in votes:
+        if user_id not in state.users:
+            results.append({"user_id": user_id, "film_id": film_id, "status": "forbidden", "match": False})
+            continue
+        # Совпадение отмечаем у первого голоса пакета за этот фильм
+        is_match = film_id in matched
+        matched.discard(film_id)
+        results.append({"user_id": user_id, "film_id": film_id, "status": "saved", "match": is_match})
+    next_film = None
+    current = outcomes.get(state.current_film)
+    if current is not None and current["completed"]:
+        next_film = await advance(state)
+    return results, next_film
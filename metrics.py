@@ -0,0 +1,199 @@
+import time
+import bisect
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин (секунды / байты)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (128, 512, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+_registry = []
+_collectors = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Metric:
+    # Значения хранятся по шардам — по одному на поток, — поэтому запись идёт без блокировок.
+    # Блокировка берётся только при появлении нового потока и при чтении всех шардов.
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def _snapshot(self) -> list:
+        with self._lock:
+            return [dict(shard) for shard in self._shards]
+
+    def _labels(self, labels, extra=()):
+        pairs = list(zip(self.labelnames, labels)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, labels=(), amount: float = 1.0):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0.0) + amount
+
+    def render(self) -> list:
+        totals = {}
+        for shard in self._snapshot():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0.0) + value
+        return [f"{self.name}{self._labels(labels)} {value:g}" for labels, value in sorted(totals.items())]
+
+
+class Gauge(Counter):
+    # Сумма по шардам: inc/dec из разных потоков корректно складываются
+    kind = "gauge"
+
+    def dec(self, labels=(), amount: float = 1.0):
+        self.inc(labels, -amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, labels=()):
+        shard = self._shard()
+        state = shard.get(labels)
+        if state is None:
+            # [счётчики по корзинам..., +Inf, сумма]
+            state = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def render(self) -> list:
+        totals = {}
+        for shard in self._snapshot():
+            for labels, state in shard.items():
+                total = totals.setdefault(labels, [0] * len(state))
+                for i, v in enumerate(list(state)):
+                    total[i] += v
+        lines = []
+        for labels, state in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), state[:-1]):
+                cumulative += count
+                le = bound if bound == "+Inf" else f"{bound:g}"
+                lines.append(f"{self.name}_bucket{self._labels(labels, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(labels)} {state[-1]:g}")
+            lines.append(f"{self.name}_count{self._labels(labels)} {cumulative}")
+        return lines
+
+
+def register_collector(fn):
+    # fn() -> список (имя, тип, описание, [(метки dict, значение)]) — считается в момент запроса /metrics
+    _collectors.append(fn)
+    return fn
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    for collector in _collectors:
+        try:
+            families = collector()
+        except Exception as e:
+            logger.error("Ошибка сборщика метрик %s: %s", collector.__name__, e)
+            continue
+        for name, kind, documentation, samples in families:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value:g}" if label_text else f"{name} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+http_requests_total = Counter("http_requests_total", "HTTP-запросы по маршруту, методу и статусу", ("route", "method", "status"))
+http_request_duration = Histogram("http_request_duration_seconds", "Время обработки HTTP-запроса", ("route", "method"))
+http_requests_in_flight = Gauge("http_requests_in_flight", "Запросы в обработке по префиксу пути", ("prefix",))
+http_response_size = Histogram("http_response_size_bytes", "Размер тела ответа", ("route",), buckets=SIZE_BUCKETS)
+upstream_requests_total = Counter("upstream_requests_total", "Запросы к API Кинопоиска", ("endpoint", "status"))
+upstream_request_duration = Histogram("upstream_request_duration_seconds", "Время запроса к API Кинопоиска", ("endpoint",))
+db_query_duration = Histogram("db_query_duration_seconds", "Время выполнения функций database.py", ("function",))
+
+
+# Префиксы путей для in-flight: фиксированный список, всё прочее (опечатки, сканеры, 404) — "other".
+# Иначе каждый /posters/<id> или случайный путь заводил бы серию навсегда
+IN_FLIGHT_PREFIXES = frozenset({
+    "/", "/metrics", "/posters",
+    "/api/sessions", "/api/user-collections", "/api/add-to-collection", "/api/films",
+    "/api/random-movie", "/api/random-series", "/api/search-by-genre-year", "/api/search-by-title",
+    "/api/search-by-actor", "/api/cache", "/api/upstream",
+})
+
+
+def in_flight_prefix(path: str) -> str:
+    segments = path.split("/")
+    for prefix in ("/" + "/".join(segments[1:3]), "/" + segments[1]):
+        if prefix in IN_FLIGHT_PREFIXES:
+            return prefix
+    return "other"
+
+
+class MetricsMiddleware:
+    # Чистый ASGI-middleware: без BaseHTTPMiddleware и без буферизации тела ответа
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        status = 500
+        size = 0
+        # До маршрутизации шаблон пути неизвестен — для in-flight берём известный префикс пути
+        in_flight_key = (in_flight_prefix(scope["path"]),)
+        http_requests_in_flight.inc(in_flight_key)
+
+        async def send_wrapper(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_flight.dec(in_flight_key)
+            route = scope.get("route")
+            # Шаблон маршрута, а не сырой путь: иначе user_id/session_id раздуют число серий
+            route_label = getattr(route, "path", None) or "unmatched"
+            http_request_duration.observe(time.perf_counter() - start, (route_label, method))
+            http_requests_total.inc((route_label, method, str(status)))
+            http_response_size.observe(size, (route_label,))
@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Field
+from typing import Dict, List, Optional
 
 class Film(BaseModel):
     id: int
@@ -12,4 +12,51 @@ class Film(BaseModel):
 
 class UserCollection(BaseModel):
     user_id: str
-    films: List[Film]
\ No newline at end of file
+    films: List[Film]
+
+class PairSessionCreate(BaseModel):
+    user_a: str
+    user_b: str
+    session_id: Optional[str] = None
+
+class SessionGenres(BaseModel):
+    user_id: str
+    genres: List[str]
+
+class SessionVote(BaseModel):
+    user_id: str
+    film_id: int
+    vote: bool
+
+class VoteResult(BaseModel):
+    match: bool
+    next_film: Optional[Film] = None
+
+# Ограничение размера пакета: держим IN (...) и транзакцию короткими
+MAX_BATCH_SIZE = 500
+
+class FilmIdsRequest(BaseModel):
+    film_ids: List[int] = Field(..., max_length=MAX_BATCH_SIZE)
+
+class BatchItemStatus(BaseModel):
+    film_id: int
+    status: str
+
+class SessionVotesBatch(BaseModel):
+    votes: List[SessionVote] = Field(..., max_length=MAX_BATCH_SIZE)
+
+class BatchVoteStatus(BaseModel):
+    user_id: str
+    film_id: int
+    status: str
+    match: bool = False
+
+class FacetCounts(BaseModel):
+    genres: Dict[str, int]
+    years: Dict[str, int]
+    ratings: Dict[str, int]
+
+class FilmFilterResult(BaseModel):
+    total: int
+    films: List[Film]
+    facets: Optional[FacetCounts] = None
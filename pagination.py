@@ -0,0 +1,126 @@
+import os
+import base64
+import asyncio
+import logging
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# Сколько страниц апстрима один запрос может загружать одновременно и сколько всего
+SEARCH_PAGE_CONCURRENCY = int(os.getenv("SEARCH_PAGE_CONCURRENCY", "4"))
+SEARCH_STREAM_MAX_PAGES = int(os.getenv("SEARCH_STREAM_MAX_PAGES", "10"))
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(page: int, **state) -> str:
+    # Курсор непрозрачен для клиента: внутреннее устройство можно менять, не ломая приложение.
+    # state — дополнительные поля конкретной выдачи (пустые не пишем)
+    data = {"page": page, **{key: value for key, value in state.items() if value}}
+    return base64.urlsafe_b64encode(orjson.dumps(data)).rstrip(b"=").decode()
+
+
+def decode_cursor_state(cursor: str = None):
+    # -> (страница, дополнительные поля курсора)
+    if not cursor:
+        return 1, {}
+    try:
+        data = orjson.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        page = int(data.pop("page"))
+    except (ValueError, TypeError, KeyError, AttributeError, orjson.JSONDecodeError) as e:
+        raise InvalidCursor(f"Некорректный курсор: {cursor}") from e
+    if page < 1:
+        raise InvalidCursor(f"Некорректный курсор: {cursor}")
+    # skip — id фильмов, уже показанных из локального индекса
+    skip = data.get("skip", [])
+    if not isinstance(skip, list) or not all(isinstance(film_id, int) for film_id in skip):
+        raise InvalidCursor(f"Некорректный курсор: {cursor}")
+    return page, data
+
+
+def next_cursor(last_page: int, pages, **state):
+    # pages=None — число страниц неизвестно, считаем, что дальше ещё что-то есть
+    if pages is not None and last_page >= pages:
+        return None
+    return encode_cursor(last_page + 1, **state)
+
+
+class PageStream:
+    # Загружает страницы [first, first + count) параллельно (не больше SEARCH_PAGE_CONCURRENCY
+    # одновременно) и отдаёт фильмы по мере прихода страниц, а не после загрузки всех
+    def __init__(self, fetch_page, first: int, count: int):
+        self.fetch_page = fetch_page
+        self.first = first
+        self.last = first + count - 1
+        self.pages = None
+        self._semaphore = asyncio.Semaphore(SEARCH_PAGE_CONCURRENCY)
+        # Задачи создаются по порядку — первая страница первой получает слот
+        self._tasks = {page: asyncio.ensure_future(self._fetch(page)) for page in range(first, self.last + 1)}
+        self._first_page = None
+
+    async def _fetch(self, page: int):
+        async with self._semaphore:
+            return await self.fetch_page(page)
+
+    async def start(self):
+        # Ждём только первую страницу: она даёт число страниц и заголовки ответа,
+        # остальные в это время уже грузятся. Ошибка первой страницы — ошибка всего запроса.
+        try:
+            self._first_page = await self._tasks.pop(self.first)
+        except BaseException:
+            self.cancel()
+            raise
+        self.pages = getattr(self._first_page, "pages", None)
+        if self.pages is not None:
+            for page in [p for p in self._tasks if p > self.pages]:
+                self._tasks.pop(page).cancel()
+            self.last = min(self.last, max(self.pages, self.first))
+        return self
+
+    @property
+    def next_cursor(self):
+        # Поля курсора задаёт первая страница (например, какие фильмы уже показаны из локального индекса)
+        return next_cursor(self.last, self.pages, **getattr(self._first_page, "cursor_state", {}))
+
+    def cancel(self):
+        for task in self._tasks.values():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                # Забираем ошибку, которую никто не прочитал, иначе asyncio ругается при сборке задачи
+                task.exception()
+        self._tasks.clear()
+
+    async def ndjson(self):
+        seen = set()
+
+        def lines(films):
+            chunk = []
+            for film in films:
+                if film["id"] not in seen:
+                    seen.add(film["id"])
+                    chunk.append(orjson.dumps(film))
+            return b"\n".join(chunk) + b"\n" if chunk else b""
+
+        try:
+            first = lines(self._first_page)
+            if first:
+                yield first
+            pending = set(self._tasks.values())
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        # Статус уже отправлен — пропускаем страницу, остальные отдаём
+                        logger.warning("Страница выдачи не загружена: %s", task.exception())
+                        continue
+                    chunk = lines(task.result())
+                    if chunk:
+                        yield chunk
+        finally:
+            # Клиент отключился или всё отдано — незавершённые загрузки больше не нужны
+            self.cancel()
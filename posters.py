@@ -0,0 +1,180 @@
+import io
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+import httpx
+from metrics import upstream_requests_total, upstream_request_duration
+from database import (
+    run_db,
+    get_poster_source,
+    get_poster,
+    touch_poster_blob,
+    save_poster,
+    evict_poster_blobs,
+)
+
+try:
+    from PIL import Image
+except ImportError:
+    # Pillow необязателен: без него миниатюры не строятся и на любой размер отдаётся оригинал
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+POSTER_CACHE_DIR = os.getenv("POSTER_CACHE_DIR", "/app/data/posters")
+POSTER_CACHE_MAX_BYTES = int(os.getenv("POSTER_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+POSTER_MAX_AGE = int(os.getenv("POSTER_MAX_AGE", str(7 * 24 * 3600)))
+POSTER_FETCH_TIMEOUT = float(os.getenv("POSTER_FETCH_TIMEOUT", "10"))
+POSTER_THUMBNAIL_QUALITY = int(os.getenv("POSTER_THUMBNAIL_QUALITY", "85"))
+# Время доступа (для LRU) пишем в БД не чаще раза в столько секунд на файл
+POSTER_TOUCH_INTERVAL = int(os.getenv("POSTER_TOUCH_INTERVAL", "3600"))
+
+ORIGINAL = "original"
+# Фиксированные размеры миниатюр — ширина в пикселях, пропорции сохраняются
+POSTER_SIZES = {"small": 160, "medium": 320}
+
+
+class PosterNotFound(Exception):
+    pass
+
+
+def _media_type(data: bytes) -> str:
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data.startswith(b"GIF8"):
+        return "image/gif"
+    return "image/jpeg"
+
+
+def _thumbnail(data: bytes, width: int) -> bytes:
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert("RGB")
+        if image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=POSTER_THUMBNAIL_QUALITY, optimize=True)
+        return output.getvalue()
+
+
+class HttpPosterFetcher:
+    # Отдельный клиент без X-API-KEY: постеры лежат на CDN, ключ туда не отправляем и квоту не тратим
+    def __init__(self):
+        self._client = None
+
+    async def __call__(self, url: str) -> bytes:
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=POSTER_FETCH_TIMEOUT, follow_redirects=True)
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = await self._client.get(url)
+            status = str(response.status_code)
+        finally:
+            upstream_request_duration.observe(time.perf_counter() - start, ("poster",))
+            upstream_requests_total.inc(("poster", status))
+        if response.status_code == 404:
+            raise PosterNotFound(url)
+        response.raise_for_status()
+        return response.content
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class PosterStore:
+    # Файлы называются хешем содержимого: одинаковые картинки (заглушки, общие постеры) хранятся один раз.
+    # fetcher — любая async-функция url -> bytes, в тестах подменяется локальной заглушкой.
+    def __init__(self, directory: str, max_bytes: int, fetcher):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fetcher = fetcher
+        self._inflight = {}
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    async def get(self, film_id: int, size: str):
+        # -> (путь к файлу, хеш, media type)
+        variant = size if size == ORIGINAL or Image is not None else ORIGINAL
+        cached = await self._cached(film_id, variant)
+        if cached is not None:
+            return cached
+        key = (film_id, variant)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(film_id, variant))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: отключение одного клиента не отменяет загрузку для остальных
+        return await asyncio.shield(task)
+
+    async def _cached(self, film_id: int, variant: str):
+        row = await run_db(get_poster, film_id, variant)
+        if row is None:
+            return None
+        digest, media_type, accessed_at = row
+        path = self.path(digest)
+        if not os.path.exists(path):
+            return None
+        if time.time() - accessed_at > POSTER_TOUCH_INTERVAL:
+            await run_db(touch_poster_blob, digest)
+        return path, digest, media_type
+
+    async def _load(self, film_id: int, variant: str):
+        original = await self._cached(film_id, ORIGINAL)
+        if original is not None:
+            data = await asyncio.to_thread(self._read, original[0])
+        else:
+            url = await run_db(get_poster_source, film_id)
+            if not url:
+                raise PosterNotFound(film_id)
+            logger.info("Загрузка постера фильма %s", film_id)
+            data = await self.fetcher(url)
+            original = await self._store(film_id, ORIGINAL, data)
+        if variant == ORIGINAL:
+            return original
+        thumbnail = await asyncio.to_thread(_thumbnail, data, POSTER_SIZES[variant])
+        return await self._store(film_id, variant, thumbnail)
+
+    async def _store(self, film_id: int, variant: str, data: bytes):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        media_type = _media_type(data)
+        if not os.path.exists(path):
+            await asyncio.to_thread(self._write, path, data)
+        await run_db(save_poster, film_id, variant, digest, media_type, len(data))
+        for evicted in await run_db(evict_poster_blobs, self.max_bytes, digest):
+            try:
+                os.unlink(self.path(evicted))
+            except FileNotFoundError:
+                pass
+        return path, digest, media_type
+
+    @staticmethod
+    def _read(path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        # Пишем во временный файл и переименовываем: читатель никогда не увидит недописанный постер
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+poster_fetcher = HttpPosterFetcher()
+poster_store = PosterStore(POSTER_CACHE_DIR, POSTER_CACHE_MAX_BYTES, poster_fetcher)
+
+
+async def close_posters():
+    await poster_fetcher.close()
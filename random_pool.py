@@ -0,0 +1,156 @@
+import os
+import random
+import asyncio
+import logging
+from kinopoisk_api import fetch_random_page
+
+logger = logging.getLogger(__name__)
+
+RANDOM_POOL_SIZE = int(os.getenv("RANDOM_POOL_SIZE", "300"))
+RANDOM_POOL_LOW_WATERMARK = int(os.getenv("RANDOM_POOL_LOW_WATERMARK", "100"))
+# Из скольких первых страниц апстрима выбираем случайные
+RANDOM_POOL_MAX_PAGE = int(os.getenv("RANDOM_POOL_MAX_PAGE", "20"))
+RANDOM_POOL_PAGES_PER_REFILL = int(os.getenv("RANDOM_POOL_PAGES_PER_REFILL", "3"))
+# Предел раундов за одно пополнение: страницы могут повторять уже лежащие в пуле фильмы
+RANDOM_POOL_MAX_ROUNDS = int(os.getenv("RANDOM_POOL_MAX_ROUNDS", "10"))
+# Сколько ждать идущего пополнения, если пулу не хватает фильмов на запрос
+RANDOM_POOL_REFILL_WAIT = float(os.getenv("RANDOM_POOL_REFILL_WAIT", "1.5"))
+# Сколько первых страниц апстрима просматривать, если и после ожидания не хватило
+RANDOM_POOL_FALLBACK_PAGES = int(os.getenv("RANDOM_POOL_FALLBACK_PAGES", "3"))
+
+
+class FilmPool:
+    def __init__(self, kind: str):
+        self.kind = kind
+        self._items = []  # пары (фильм, жанры)
+        self._ids = set()
+        self._refill_task = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def _take(self, index: int):
+        # Удаление за O(1): меняем с последним и обрезаем хвост
+        items = self._items
+        items[index], items[-1] = items[-1], items[index]
+        film, _ = items.pop()
+        self._ids.discard(film["id"])
+        return film
+
+    def sample(self, count: int, genre: str = None, year: int = None) -> list:
+        if genre is None and year is None:
+            result = [self._take(random.randrange(len(self._items))) for _ in range(min(count, len(self._items)))]
+        else:
+            genre = genre.casefold() if genre else None
+            matching = [
+                i for i, (film, genres) in enumerate(self._items)
+                if (year is None or film["year"] == year)
+                and (genre is None or any(g.casefold() == genre for g in genres))
+            ]
+            chosen = random.sample(matching, min(count, len(matching)))
+            # Удаляем с конца, чтобы индексы ещё не взятых элементов не сдвигались
+            result = [self._take(i) for i in sorted(chosen, reverse=True)]
+            random.shuffle(result)
+        if len(self._items) < RANDOM_POOL_LOW_WATERMARK:
+            self.request_refill()
+        return result
+
+    def request_refill(self):
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill())
+        return self._refill_task
+
+    async def _refill(self):
+        for _ in range(RANDOM_POOL_MAX_ROUNDS):
+            if len(self._items) >= RANDOM_POOL_SIZE:
+                break
+            pages = random.sample(range(1, RANDOM_POOL_MAX_PAGE + 1), min(RANDOM_POOL_PAGES_PER_REFILL, RANDOM_POOL_MAX_PAGE))
+            results = await asyncio.gather(*(fetch_random_page(self.kind, p) for p in pages), return_exceptions=True)
+            added = 0
+            failed = 0
+            for page_items in results:
+                if isinstance(page_items, Exception):
+                    logger.error("Ошибка пополнения пула '%s': %s", self.kind, page_items)
+                    failed += 1
+                    continue
+                for film, genres in page_items:
+                    if film["id"] not in self._ids:
+                        self._ids.add(film["id"])
+                        self._items.append((film, genres))
+                        added += 1
+            logger.info("Пул '%s' пополнен на %s, всего %s", self.kind, added, len(self._items))
+            if failed == len(results):
+                # Апстрим недоступен — следующая попытка при очередной выборке
+                break
+
+    async def wait_refill(self, timeout: float):
+        task = self._refill_task
+        if task is None or task.done():
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def stop(self):
+        if self._refill_task is not None and not self._refill_task.done():
+            self._refill_task.cancel()
+            try:
+                await self._refill_task
+            except asyncio.CancelledError:
+                pass
+
+
+pools = {
+    "movie": FilmPool("movie"),
+    "series": FilmPool("series"),
+}
+
+async def start_pools():
+    for pool in pools.values():
+        pool.request_refill()
+
+
+async def stop_pools():
+    for pool in pools.values():
+        await pool.stop()
+
+
+async def random_films(kind: str, count: int = 5, genre: str = None, year: int = None) -> list:
+    pool = pools[kind]
+    result = pool.sample(count, genre, year)
+    if len(result) < count:
+        # Пул холодный (сразу после старта) — недолго ждём идущего пополнения
+        await pool.wait_refill(RANDOM_POOL_REFILL_WAIT)
+        taken = {film["id"] for film in result}
+        result += [film for film in pool.sample(count - len(result), genre, year) if film["id"] not in taken]
+    if len(result) < count:
+        # Под фильтр в пуле ничего нет или апстрим медлит — добираем из (кэшированных) первых страниц
+        logger.info("Пул '%s' выдал %s из %s, добираем из апстрима", kind, len(result), count)
+        seen = {film["id"] for film in result}
+        genre = genre.casefold() if genre else None
+        for page in range(1, RANDOM_POOL_FALLBACK_PAGES + 1):
+            try:
+                page_items = await fetch_random_page(kind, page)
+            except Exception as e:
+                if not result:
+                    raise
+                # Часть уже набрана — лучше отдать её, чем ошибку
+                logger.warning("Пул '%s': догрузка из апстрима не удалась, отдаём %s из %s: %s", kind, len(result), count, e)
+                return result
+            for film, genres in page_items:
+                if len(result) >= count:
+                    return result
+                if film["id"] in seen:
+                    continue
+                if year is not None and film["year"] != year:
+                    continue
+                if genre and not any(g.casefold() == genre for g in genres):
+                    continue
+                seen.add(film["id"])
+                result.append(film)
+    return result
+
+
+def pool_stats():
+    return {kind: len(pool) for kind, pool in pools.items()}
@@ -0,0 +1,89 @@
+import os
+import numpy as np
+from catalog_snapshot import CatalogSnapshot, split_rows
+
+RANKING_MAX_CANDIDATES = int(os.getenv("RANKING_MAX_CANDIDATES", "20000"))
+RANKING_REFRESH_SECONDS = float(os.getenv("RANKING_REFRESH_SECONDS", "60"))
+
+# Веса слагаемых оценки кандидата
+WEIGHT_BOTH = 2.0      # жанр нравится обоим
+WEIGHT_EITHER = 1.0    # жанр нравится хотя бы одному
+WEIGHT_RATING = 1.0
+WEIGHT_RECENCY = 0.25
+
+
+class CandidateSet:
+    def __init__(self, ids, genre_lists, ratings, years):
+        # Жанры сессии вводит пользователь, в каталоге они как у апстрима — сравниваем без учёта регистра
+        genre_lists = [[g.casefold() for g in genres] for genres in genre_lists]
+        self.vocabulary = sorted({g for genres in genre_lists for g in genres})
+        self.genre_index = {g: i for i, g in enumerate(self.vocabulary)}
+        self.ids = np.asarray(ids, dtype=np.int64)
+
+        # Мульти-хот матрица жанров: строка — фильм, столбец — жанр
+        self.genre_matrix = np.zeros((len(ids), max(len(self.vocabulary), 1)), dtype=np.float32)
+        rows = [i for i, genres in enumerate(genre_lists) for _ in genres]
+        cols = [self.genre_index[g] for genres in genre_lists for g in genres]
+        self.genre_matrix[rows, cols] = 1.0
+
+        ratings = np.array([r if r is not None else np.nan for r in ratings], dtype=np.float32)
+        fill = np.nanmean(ratings) if np.isfinite(ratings).any() else 0.0
+        self.ratings = np.nan_to_num(ratings, nan=fill) / 10.0
+
+        years = np.array([y if y is not None else 0 for y in years], dtype=np.float32)
+        known = years > 0
+        if known.any():
+            low, high = years[known].min(), years[known].max()
+            self.recency = np.where(known, (years - low) / max(high - low, 1.0), 0.0).astype(np.float32)
+        else:
+            self.recency = np.zeros(len(ids), dtype=np.float32)
+
+        # Часть оценки, не зависящая от сессии, считается один раз
+        self.base_score = WEIGHT_RATING * self.ratings + WEIGHT_RECENCY * self.recency
+
+    def __len__(self):
+        return len(self.ids)
+
+    def preference_vector(self, genres) -> np.ndarray:
+        vector = np.zeros(self.genre_matrix.shape[1], dtype=np.float32)
+        indices = list({self.genre_index[g] for g in (g.casefold() for g in genres) if g in self.genre_index})
+        if indices:
+            vector[indices] = 1.0 / len(indices)
+        return vector
+
+    def shown_mask(self, shown_ids) -> np.ndarray:
+        # shown_ids — отсортированный массив из сессии; isin без обхода в Python
+        if not len(shown_ids):
+            return np.zeros(len(self.ids), dtype=bool)
+        return np.isin(self.ids, np.asarray(shown_ids, dtype=np.int64), assume_unique=True)
+
+    def rank(self, genres_a, genres_b, shown_ids=(), k: int = 10) -> list:
+        if not len(self.ids):
+            return []
+        # Доля любимых жанров каждого участника, которую покрывает фильм.
+        # Два отдельных gemv и поэлементные операции заметно быстрее редукций по оси шириной 2
+        affinity_a = self.genre_matrix @ self.preference_vector(genres_a)
+        affinity_b = self.genre_matrix @ self.preference_vector(genres_b)
+        scores = np.minimum(affinity_a, affinity_b)
+        scores *= WEIGHT_BOTH
+        affinity_a += affinity_b
+        affinity_a *= WEIGHT_EITHER / 2
+        scores += affinity_a
+        scores += self.base_score
+        scores[self.shown_mask(shown_ids)] = -np.inf
+
+        k = min(k, len(scores))
+        top = np.argpartition(scores, len(scores) - k)[-k:]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [int(self.ids[i]) for i in top if np.isfinite(scores[i])]
+
+
+def build_candidates(rows) -> CandidateSet:
+    return CandidateSet(*split_rows(rows))
+
+
+candidates_snapshot = CatalogSnapshot("кандидаты ранжирования", build_candidates, RANKING_MAX_CANDIDATES, RANKING_REFRESH_SECONDS)
+
+
+async def get_candidates() -> CandidateSet:
+    return await candidates_snapshot.get()
@@ -0,0 +1,68 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import orjson
+from database import run_db, delete_expired_sessions, incremental_vacuum
+from matching import match_index
+from workers import SHARED_STATE
+
+logger = logging.getLogger(__name__)
+
+# Сессия без записей (голосов, жанров, показов) дольше этого срока удаляется целиком
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", str(30 * 24 * 3600)))
+SESSION_GC_INTERVAL = float(os.getenv("SESSION_GC_INTERVAL", "3600"))
+# Удаляем пачками: каждая — короткая транзакция, запись в базу между ними не простаивает
+SESSION_GC_BATCH = int(os.getenv("SESSION_GC_BATCH", "500"))
+SESSION_GC_MAX_BATCHES = int(os.getenv("SESSION_GC_MAX_BATCHES", "20"))
+# Сколько свободных страниц за проход возвращать ОС (страница — 4 КБ)
+DB_VACUUM_PAGES = int(os.getenv("DB_VACUUM_PAGES", "2000"))
+# При нескольких воркерах остальные узнают об удалении сессии из общей ленты событий
+EXPIRED_EVENT = orjson.dumps({"type": "expired"}).decode() if SHARED_STATE else None
+
+
+class SessionCompactor:
+    def __init__(self):
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run_once(self) -> int:
+        inactive_before = int(time.time()) - SESSION_TTL_SECONDS
+        deleted = 0
+        for _ in range(SESSION_GC_MAX_BATCHES):
+            session_ids = await run_db(delete_expired_sessions, inactive_before, SESSION_GC_BATCH, EXPIRED_EVENT)
+            for session_id in session_ids:
+                match_index.forget(session_id)
+            deleted += len(session_ids)
+            if len(session_ids) < SESSION_GC_BATCH:
+                break
+        freed = await run_db(incremental_vacuum, DB_VACUUM_PAGES)
+        if deleted or freed:
+            logger.info("Удалено истёкших сессий: %s, освобождено страниц базы: %s", deleted, freed)
+        return deleted
+
+    async def _run(self):
+        # Первый проход вскоре после старта (частые перезапуски не должны откладывать очистку),
+        # джиттер — чтобы при нескольких воркерах проходы не совпадали по времени
+        await asyncio.sleep(random.uniform(10, 60))
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error("Ошибка очистки истёкших сессий: %s", e)
+            await asyncio.sleep(SESSION_GC_INTERVAL * random.uniform(0.9, 1.1))
+
+
+session_compactor = SessionCompactor()
@@ -0,0 +1,97 @@
+import os
+import sys
+import asyncio
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import upstream_guard
+from upstream_guard import UpstreamGovernor, CircuitBreaker
+
+REQUEST = httpx.Request("GET", "https://example.test/api")
+
+
+def ok():
+    return httpx.Response(200, request=REQUEST)
+
+
+def make_governor(monkeypatch) -> UpstreamGovernor:
+    monkeypatch.setattr(upstream_guard, "KINOPOISK_MAX_RETRIES", 0)
+    governor = UpstreamGovernor()
+    # Открывается с первой ошибки и сразу готов к пробному запросу
+    governor.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    return governor
+
+
+async def open_breaker(governor):
+    async def fail():
+        raise httpx.ConnectError("down", request=REQUEST)
+
+    with pytest.raises(httpx.ConnectError):
+        await governor.call(fail)
+    assert governor.breaker.state == CircuitBreaker.OPEN
+
+
+def test_probe_failing_with_unexpected_error_does_not_wedge_breaker(monkeypatch):
+    async def scenario():
+        governor = make_governor(monkeypatch)
+        await open_breaker(governor)
+
+        async def bad_body():
+            raise httpx.DecodingError("broken gzip", request=REQUEST)
+
+        with pytest.raises(httpx.DecodingError):
+            await governor.call(bad_body)
+        assert governor.breaker.state == CircuitBreaker.OPEN
+
+        async def healthy():
+            return ok()
+
+        response = await governor.call(healthy)
+        assert response.status_code == 200
+        assert governor.breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_probe_releases_breaker(monkeypatch):
+    async def scenario():
+        governor = make_governor(monkeypatch)
+        await open_breaker(governor)
+
+        async def hang():
+            await asyncio.sleep(60)
+
+        probe = asyncio.ensure_future(governor.call(hang))
+        await asyncio.sleep(0.01)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+        async def healthy():
+            return ok()
+
+        assert (await governor.call(healthy)).status_code == 200
+
+    asyncio.run(scenario())
+
+
+def test_long_retry_after_fails_fast(monkeypatch):
+    async def scenario():
+        governor = make_governor(monkeypatch)
+        monkeypatch.setattr(upstream_guard, "KINOPOISK_MAX_RETRIES", 3)
+        calls = 0
+
+        async def quota_exhausted():
+            nonlocal calls
+            calls += 1
+            return httpx.Response(429, headers={"Retry-After": "3600"}, request=REQUEST)
+
+        response = await asyncio.wait_for(governor.call(quota_exhausted), timeout=1)
+        assert response.status_code == 429
+        assert calls == 1
+        assert upstream_guard.parse_retry_after(response) == 3600
+
+    asyncio.run(scenario())
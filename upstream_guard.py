@@ -0,0 +1,215 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from email.utils import parsedate_to_datetime
+import httpx
+from workers import WORKER_COUNT
+
+logger = logging.getLogger(__name__)
+
+# Квота ключа: устойчивая скорость (запросов в секунду) и допустимый всплеск.
+# Ключ один на все воркеры, поэтому каждый получает свою долю квоты.
+KINOPOISK_RATE_PER_SEC = float(os.getenv("KINOPOISK_RATE_PER_SEC", "10")) / WORKER_COUNT
+KINOPOISK_BURST = max(1, int(os.getenv("KINOPOISK_BURST", "20")) // WORKER_COUNT)
+KINOPOISK_MAX_CONCURRENCY = max(1, int(os.getenv("KINOPOISK_MAX_CONCURRENCY", "10")) // WORKER_COUNT)
+KINOPOISK_MAX_RETRIES = int(os.getenv("KINOPOISK_MAX_RETRIES", "3"))
+KINOPOISK_BACKOFF_BASE = float(os.getenv("KINOPOISK_BACKOFF_BASE", "0.2"))
+KINOPOISK_BACKOFF_MAX = float(os.getenv("KINOPOISK_BACKOFF_MAX", "5"))
+KINOPOISK_RETRY_AFTER_MAX = float(os.getenv("KINOPOISK_RETRY_AFTER_MAX", "30"))
+KINOPOISK_BREAKER_FAILURES = int(os.getenv("KINOPOISK_BREAKER_FAILURES", "5"))
+KINOPOISK_BREAKER_RESET = float(os.getenv("KINOPOISK_BREAKER_RESET", "30"))
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Апстрим недоступен, повтор через {retry_after:.0f} с")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> float:
+        # Ожидающие встают в очередь за замком — токены раздаются по порядку прихода
+        waited = 0.0
+        async with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                delay = (1 - self.tokens) / self.rate
+                waited = delay
+                await asyncio.sleep(delay)
+                self._refill()
+            self.tokens -= 1
+        return waited
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def before_call(self):
+        if self.state == self.OPEN:
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                raise CircuitOpenError(remaining)
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            # Пробный запрос один; остальные сразу получают отказ
+            if self._probe_in_flight:
+                raise CircuitOpenError(self.reset_timeout)
+            self._probe_in_flight = True
+
+    def release_probe(self):
+        # Пробный запрос завершён при любом исходе — в том числе при отмене или неожиданной ошибке
+        self._probe_in_flight = False
+
+    def record_success(self):
+        self._probe_in_flight = False
+        self.failures = 0
+        if self.state != self.CLOSED:
+            logger.info("Апстрим снова доступен, предохранитель закрыт")
+        self.state = self.CLOSED
+
+    def record_failure(self):
+        self._probe_in_flight = False
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.error("Предохранитель апстрима открыт после %s ошибок подряд", self.failures)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+def parse_retry_after(response: httpx.Response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return max(seconds, 0.0)
+
+
+def _backoff(attempt: int) -> float:
+    # Экспоненциальная задержка с полным джиттером
+    return random.uniform(0, min(KINOPOISK_BACKOFF_MAX, KINOPOISK_BACKOFF_BASE * 2 ** attempt))
+
+
+class UpstreamGovernor:
+    def __init__(self):
+        self.bucket = TokenBucket(KINOPOISK_RATE_PER_SEC, KINOPOISK_BURST)
+        self.breaker = CircuitBreaker(KINOPOISK_BREAKER_FAILURES, KINOPOISK_BREAKER_RESET)
+        self.semaphore = asyncio.Semaphore(KINOPOISK_MAX_CONCURRENCY)
+        self.in_flight = 0
+        self.stats = {
+            "requests": 0,
+            "retries": 0,
+            "throttled": 0,
+            "throttled_seconds": 0.0,
+            "rate_limited": 0,
+            "failures": 0,
+            "rejected_open": 0,
+        }
+
+    async def call(self, send):
+        # send() выполняет один HTTP-запрос и возвращает httpx.Response
+        attempt = 0
+        while True:
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                self.stats["rejected_open"] += 1
+                raise
+            try:
+                response = await self._send(send)
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                self.stats["failures"] += 1
+                self.breaker.record_failure()
+                if attempt >= KINOPOISK_MAX_RETRIES:
+                    raise
+                delay = _backoff(attempt)
+                logger.warning("Сетевая ошибка апстрима (%r), повтор через %.2f с", e, delay)
+            except Exception:
+                # Прочие ошибки попытки (например, httpx.DecodingError) — тоже отказ, но без повтора
+                self.stats["failures"] += 1
+                self.breaker.record_failure()
+                raise
+            else:
+                if response.status_code not in RETRYABLE_STATUSES:
+                    self.breaker.record_success()
+                    return response
+                retry_after = None
+                if response.status_code == 429:
+                    # Превышение квоты — это не поломка апстрима, предохранитель не трогаем
+                    self.stats["rate_limited"] += 1
+                    self.breaker.record_success()
+                    retry_after = parse_retry_after(response)
+                    if retry_after is not None and retry_after > KINOPOISK_RETRY_AFTER_MAX:
+                        # Квота кончилась надолго (например, суточная) — ждать бессмысленно,
+                        # Retry-After уходит клиенту вместе с ошибкой
+                        return response
+                else:
+                    self.stats["failures"] += 1
+                    self.breaker.record_failure()
+                if attempt >= KINOPOISK_MAX_RETRIES:
+                    return response
+                delay = retry_after if retry_after is not None else _backoff(attempt)
+                logger.warning("Апстрим ответил %s, повтор через %.2f с", response.status_code, delay)
+            finally:
+                self.breaker.release_probe()
+            attempt += 1
+            self.stats["retries"] += 1
+            await asyncio.sleep(delay)
+
+    async def _send(self, send):
+        waited = await self.bucket.acquire()
+        if waited:
+            self.stats["throttled"] += 1
+            self.stats["throttled_seconds"] += waited
+        self.stats["requests"] += 1
+        async with self.semaphore:
+            self.in_flight += 1
+            try:
+                return await send()
+            finally:
+                self.in_flight -= 1
+
+    def snapshot(self):
+        self.bucket._refill()
+        return {
+            **self.stats,
+            "in_flight": self.in_flight,
+            "max_concurrency": KINOPOISK_MAX_CONCURRENCY,
+            "tokens": round(self.bucket.tokens, 2),
+            "rate_per_sec": self.bucket.rate,
+            "breaker_state": self.breaker.state,
+            "breaker_failures": self.breaker.failures,
+        }
+
+
+governor = UpstreamGovernor()
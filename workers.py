@@ -0,0 +1,51 @@
+import os
+import math
+
+
+def _read(path: str) -> str:
+    with open(path) as f:
+        return f.read().strip()
+
+
+def _cgroup_cpu_limit():
+    # Квота CPU контейнера (docker --cpus): cgroup v2, затем v1. None — не ограничена или не читается
+    try:
+        quota, period = _read("/sys/fs/cgroup/cpu.max").split()
+    except (OSError, ValueError):
+        try:
+            quota = _read("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+            period = _read("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+        except OSError:
+            return None
+    if quota in ("max", "-1"):
+        return None
+    try:
+        return max(1, math.ceil(int(quota) / int(period)))
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def available_cpus() -> int:
+    # os.cpu_count() видит все ядра хоста, а не доступные процессу: учитываем привязку к ядрам
+    # (taskset, cpuset контейнера) и квоту CPU (docker --cpus)
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    return min(cpus, limit) if limit else cpus
+
+
+# Число процессов uvicorn: целое или "auto" — по числу доступных ядер
+def worker_count() -> int:
+    value = os.getenv("WORKERS", "1").strip().lower()
+    if value == "auto":
+        return available_cpus()
+    return max(1, int(value))
+
+
+WORKER_COUNT = worker_count()
+
+# Состояние, общее для процессов (кэш второго уровня, события сессий через БД), включается само
+# при нескольких воркерах. SHARED_STATE=1 — если воркеры запускает внешний менеджер (gunicorn и т.п.)
+SHARED_STATE = os.getenv("SHARED_STATE", "1" if WORKER_COUNT > 1 else "0") == "1"